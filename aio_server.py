@@ -0,0 +1,165 @@
+import asyncio
+import logging
+
+import grpc
+import chatservice_pb2_grpc
+from broker import Gap
+from metrics import AioMetricsInterceptor
+from server import DEFAULT_ROOM, BATCH_WINDOW_MS, MAX_BATCH, RESUME_AHEAD_ERROR, SLOW_CONSUMER_ERROR
+
+log = logging.getLogger(__name__)
+
+
+class AioChatService(chatservice_pb2_grpc.ChatServiceServicer):
+    """grpc.aio front end for a ChatService.
+
+    Streams are coroutines waiting on an asyncio broadcast queue, so an
+    idle subscriber costs no thread. Calls that may block on the database
+    are moved to a worker thread, heartbeats only touch memory and run inline.
+    """
+
+    def __init__(self, chat_service):
+        self.chat_service = chat_service
+
+    async def SendMessage(self, request, context):
+        rejected = self.chat_service.admit_message(request, context)
+        if rejected is not None:
+            context.set_trailing_metadata(rejected.trailing_metadata())
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, rejected.details)
+        return await asyncio.to_thread(self.chat_service.handle_message, request, context)
+
+    async def SendStream(self, request_iterator, context):
+        # Same as ChatService.SendStream: a reader task accepts requests as they
+        # arrive while this generator acks them in order
+        accepted = asyncio.Queue()
+
+        async def read_requests():
+            try:
+                async for request in request_iterator:
+                    pending = await asyncio.to_thread(self.chat_service.accept_message, request)
+                    accepted.put_nowait((request, pending))
+            except Exception:
+                pass  # The stream was cancelled or broke
+            finally:
+                accepted.put_nowait(None)
+
+        reader = asyncio.create_task(read_requests())
+        try:
+            while True:
+                item = await accepted.get()
+                if item is None:
+                    break
+                request, pending = item
+                yield await asyncio.to_thread(self.chat_service.send_ack, request, pending)
+        finally:
+            reader.cancel()
+
+    async def ChatStream(self, request, context):
+        transport = self.chat_service.transport
+        transport.enable_compression(context)
+        async for page in self._stream_pages(DEFAULT_ROOM, 0, 0, context):
+            for message in page:
+                transport.before_send(context, message)
+                yield message
+
+    async def ResumeStream(self, request, context):
+        transport = self.chat_service.transport
+        transport.enable_compression(context)
+        room = request.room or DEFAULT_ROOM
+        async for page in self._stream_pages(room, request.since_seq, request.max_backlog, context):
+            for message in page:
+                transport.before_send(context, message)
+                yield message
+
+    async def BatchStream(self, request, context):
+        room = request.room or DEFAULT_ROOM
+        window = min(request.batch_window_ms or BATCH_WINDOW_MS, 1000) / 1000
+        max_batch = request.max_batch or MAX_BATCH
+        self.chat_service.transport.enable_compression(context)
+        async for page in self._stream_pages(room, request.since_seq, request.max_backlog, context, window, max_batch):
+            yield self.chat_service.batch_response(context, page)
+
+    async def GetHistory(self, request, context):
+        self.chat_service.transport.enable_compression(context)
+        page = await asyncio.to_thread(self.chat_service.history_page, request)
+        return self.chat_service.batch_response(context, page)
+
+    async def _stream_pages(self, room, since_seq, max_backlog, context, window=0, max_batch=MAX_BATCH):
+        # Same ordering rules as ChatService._stream_messages: subscribe first,
+        # replay the backlog, then skip live messages already replayed
+        if since_seq > self.chat_service.last_seq and await asyncio.to_thread(self.chat_service.resume_ahead, since_seq):
+            await context.abort(grpc.StatusCode.OUT_OF_RANGE, RESUME_AHEAD_ERROR)
+        subscription = self.chat_service.broker.subscribe_async(room)
+        last_seq = since_seq
+
+        try:
+            pages = self.chat_service.backlog_pages(room, since_seq, max_backlog)
+            async for page in self._in_thread(pages):
+                last_seq = page[-1].seq
+                yield page
+
+            while True:
+                batch = await subscription.get_batch(max_batch, window)
+                if not batch:
+                    break
+                pages = self.chat_service.live_pages(room, batch, last_seq)
+                if any(isinstance(item, Gap) for item in batch):
+                    # Catching up from history may hit the database
+                    pages = self._in_thread(pages)
+                else:
+                    pages = self._inline(pages)
+                async for page in pages:
+                    last_seq = max(last_seq, page[-1].seq)
+                    yield page
+            if subscription.overflowed:
+                await context.abort(grpc.StatusCode.ABORTED, SLOW_CONSUMER_ERROR)
+        finally:
+            subscription.close()
+
+    async def _in_thread(self, pages):
+        # Advance a blocking page generator on a worker thread
+        while True:
+            page = await asyncio.to_thread(next, pages, None)
+            if page is None:
+                return
+            yield page
+
+    async def _inline(self, pages):
+        for page in pages:
+            yield page
+
+    async def Connect(self, request, context):
+        # Reserving the username may go to MongoDB
+        return await asyncio.to_thread(self.chat_service.Connect, request, context)
+
+    async def Heartbeat(self, request, context):
+        return self.chat_service.Heartbeat(request, context)
+
+    async def Disconnect(self, request, context):
+        return await asyncio.to_thread(self.chat_service.Disconnect, request, context)
+
+    async def KeepAlive(self, request_iterator, context):
+        username = None
+        try:
+            async for request in request_iterator:
+                username = request.username
+                yield self.chat_service.Heartbeat(request, context)
+        finally:
+            if username is not None:
+                await asyncio.to_thread(self.chat_service.disconnect_user, username)
+
+
+async def serve_aio(chat_service, address):
+    server = grpc.aio.server(
+        options=chat_service.transport.server_options(),
+        interceptors=[AioMetricsInterceptor(chat_service.metrics)],
+    )
+    chatservice_pb2_grpc.add_ChatServiceServicer_to_server(AioChatService(chat_service), server)
+    server.add_insecure_port(address)
+    await server.start()
+
+    log.info("Server started (asyncio)")
+    try:
+        await server.wait_for_termination()
+    finally:
+        await server.stop(grace=2)
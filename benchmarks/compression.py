@@ -0,0 +1,181 @@
+"""Wire size and latency of stream compression settings.
+
+For each setting a ChatService is started with a history of --history
+messages, and a client connects through a byte-counting TCP proxy. It
+reports, server to client:
+  - replay: time and bytes to receive the whole history over BatchStream,
+  - live: bytes per message and send-to-receive latency of single messages
+    sent while the stream is open.
+
+--store picks the server's message store, the in-memory one by default.
+The mongo store uses mongomock when it is installed, otherwise a MongoDB
+on localhost:27017 (its chat_db is written to); seeding mongomock slows
+down quickly as the history grows, so keep --history small with it.
+
+    python benchmarks/compression.py --history 20000 --live 200
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import grpc
+import chatservice_pb2
+import chatservice_pb2_grpc
+from server import ChatService, DEFAULT_ROOM
+from storage import LOG, MEMORY, STORES, LogStore, MemoryStore, MongoStore
+from transport import TransportConfig
+
+# (compression, threshold) pairs to compare
+SETTINGS = [('none', 1024), ('gzip', 0), ('gzip', 1024), ('deflate', 1024)]
+
+WORDS = ("the a to and you it is that of in for on what was lol ok yes no "
+         "meeting lunch today tomorrow deploy build server client review "
+         "thanks sounds good can we push later merge branch test").split()
+
+
+def make_mongo_client():
+    try:
+        import mongomock
+        return mongomock.MongoClient()
+    except ImportError:
+        from pymongo import MongoClient
+        return MongoClient('localhost', 27017)
+
+
+def make_store(name):
+    if name == MEMORY:
+        return MemoryStore()
+    if name == LOG:
+        return LogStore(tempfile.mkdtemp(prefix='chat-bench-'))
+    return MongoStore(make_mongo_client().chat_db, DEFAULT_ROOM)
+
+
+def chat_line(rng):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20)))
+
+
+class CountingProxy:
+    """Forwards local TCP connections to a server and counts the bytes"""
+
+    def __init__(self, upstream_port):
+        self.upstream_port = upstream_port
+        self.downstream_bytes = 0  # server -> client
+        self.upstream_bytes = 0    # client -> server
+        self.lock = threading.Lock()
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(('127.0.0.1', self.upstream_port))
+            threading.Thread(target=self._pump, args=(client, server, 'upstream_bytes'), daemon=True).start()
+            threading.Thread(target=self._pump, args=(server, client, 'downstream_bytes'), daemon=True).start()
+
+    def _pump(self, source, target, counter):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                with self.lock:
+                    setattr(self, counter, getattr(self, counter) + len(data))
+                target.sendall(data)
+        except OSError:
+            pass
+        finally:
+            source.close()
+            target.close()
+
+    def reset(self):
+        with self.lock:
+            self.downstream_bytes = 0
+            self.upstream_bytes = 0
+
+    def close(self):
+        self.listener.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(compression, threshold, args):
+    transport = TransportConfig(compression=compression, compression_threshold=threshold)
+    chat_service = ChatService(store=make_store(args.store), transport=transport)
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10), options=transport.server_options())
+    chatservice_pb2_grpc.add_ChatServiceServicer_to_server(chat_service, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+
+    rng = random.Random(1)
+    room = 'compression-bench'
+    for _ in range(args.history):
+        chat_service.save_history(chatservice_pb2.MessageRequest(username='alice', message=chat_line(rng), room=room))
+    chat_service.writer.wait_written()
+
+    proxy = CountingProxy(port)
+    channel = grpc.insecure_channel(f'127.0.0.1:{proxy.port}', options=transport.channel_options())
+    stub = chatservice_pb2_grpc.ChatServiceStub(channel)
+    grpc.channel_ready_future(channel).result(timeout=5)
+    proxy.reset()
+
+    # Replay: the whole history as backlog pages
+    started = time.perf_counter()
+    stream = stub.BatchStream(chatservice_pb2.StreamRequest(room=room))
+    received = 0
+    batches = iter(stream)
+    while received < args.history:
+        received += len(next(batches).messages)
+    replay_seconds = time.perf_counter() - started
+    replay_bytes = proxy.downstream_bytes
+
+    # Live: one message at a time, timed from send to arrival on the stream
+    sender = chatservice_pb2_grpc.ChatServiceStub(grpc.insecure_channel(f'127.0.0.1:{port}'))
+    sender.Connect(chatservice_pb2.PresenceRequest(username='bob'))
+    proxy.reset()
+    latencies = []
+    for _ in range(args.live):
+        started = time.perf_counter()
+        sender.SendMessage(chatservice_pb2.MessageRequest(username='bob', message=chat_line(rng), room=room))
+        next(batches)
+        latencies.append((time.perf_counter() - started) * 1000)
+    live_bytes = proxy.downstream_bytes / args.live
+
+    stream.cancel()
+    channel.close()
+    proxy.close()
+    server.stop(0)
+    chat_service.close()
+    return replay_seconds, replay_bytes, live_bytes, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--store', choices=STORES, default=MEMORY)
+    parser.add_argument('--history', type=int, default=20000, help="messages replayed over the stream")
+    parser.add_argument('--live', type=int, default=200, help="single messages timed after the replay")
+    args = parser.parse_args()
+
+    print(f"{'setting':<16} {'replay s':>9} {'replay KiB':>11} {'live B/msg':>11} {'live p50 ms':>12} {'live p99 ms':>12}")
+    for compression, threshold in SETTINGS:
+        replay_seconds, replay_bytes, live_bytes, latencies = run(compression, threshold, args)
+        print(f"{compression + ' >=' + str(threshold):<16} {replay_seconds:>9.2f} {replay_bytes / 1024:>11.1f} "
+              f"{live_bytes:>11.0f} {percentile(latencies, 0.5):>12.2f} {percentile(latencies, 0.99):>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""Load benchmark for ChatService.
+
+Runs the server in a child process and drives it from this process with
+N senders and M stream subscribers. Reports:
+  - send throughput, all senders together,
+  - fan-out latency from send to arrival on each subscriber's stream,
+  - server CPU time and peak RSS,
+  - time to replay the whole history of a room, for growing history sizes.
+
+--store picks the server's message store, the in-memory one by default.
+The log store writes to a temporary directory. The mongo store uses
+mongomock (or a MongoDB on localhost:27017 when mongomock is not
+installed); seeding mongomock slows down quickly as the history grows,
+so pass smaller --history-sizes with it.
+
+    python benchmarks/load.py --senders 4 --subscribers 20 --messages 500
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import grpc
+import chatservice_pb2
+import chatservice_pb2_grpc
+from storage import LOG, MEMORY, STORES, LogStore, MemoryStore, MongoStore
+
+LOAD_ROOM = 'load-bench'
+REPLAY_ROOM = 'replay-bench'
+
+
+def make_mongo_client():
+    try:
+        import mongomock
+        return mongomock.MongoClient()
+    except ImportError:
+        from pymongo import MongoClient
+        return MongoClient('localhost', 27017)
+
+
+def make_store(name):
+    if name == MEMORY:
+        return MemoryStore()
+    if name == LOG:
+        return LogStore(tempfile.mkdtemp(prefix='chat-bench-'))
+    from server import DEFAULT_ROOM
+    return MongoStore(make_mongo_client().chat_db, DEFAULT_ROOM)
+
+
+def resource_usage():
+    import resource
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return {'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_mb': max_rss / (1024 * 1024)}
+
+
+def run_server(conn, store, history, workers):
+    # Child process: seed the replay room, serve, answer 'stats' until 'stop'
+    from server import ChatService
+    chat_service = ChatService(store=make_store(store))
+    for n in range(history):
+        chat_service.save_history(chatservice_pb2.MessageRequest(username='seed', message=f"history {n}", room=REPLAY_ROOM))
+    chat_service.writer.wait_written()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers), options=chat_service.transport.server_options())
+    chatservice_pb2_grpc.add_ChatServiceServicer_to_server(chat_service, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    conn.send(port)
+
+    while True:
+        command = conn.recv()
+        if command == 'stats':
+            conn.send(dict(resource_usage(), streams=chat_service.broker.stats()))
+        elif command == 'stop':
+            break
+    server.stop(0)
+    chat_service.close()
+
+
+class ServerProcess:
+    def __init__(self, store, history=0, workers=100):
+        context = multiprocessing.get_context('spawn')  # grpc does not survive fork
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=run_server, args=(child_conn, store, history, workers), daemon=True)
+        self.process.start()
+        self.port = self.conn.recv()
+
+    def stats(self):
+        self.conn.send('stats')
+        return self.conn.recv()
+
+    def stop(self):
+        self.conn.send('stop')
+        self.process.join(10)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_load(args):
+    server = ServerProcess(args.store, workers=args.senders + args.subscribers + 10)
+    address = f'127.0.0.1:{server.port}'
+    expected = args.senders * args.messages
+
+    # Subscribers: one channel and stream each, latency taken from the send
+    # time carried in the message text
+    latencies = []
+    latency_lock = threading.Lock()
+    done = threading.Barrier(args.subscribers + 1)
+    calls = []
+
+    def subscribe(call):
+        received = 0
+        mine = []
+        try:
+            for batch in call:
+                now = time.perf_counter()
+                for message in batch.messages:
+                    mine.append(now - float(message.message))
+                received += len(batch.messages)
+                if received >= expected:
+                    break
+        except grpc.RpcError:
+            pass
+        with latency_lock:
+            latencies.extend(mine)
+        done.wait()
+
+    for _ in range(args.subscribers):
+        stub = chatservice_pb2_grpc.ChatServiceStub(grpc.insecure_channel(address))
+        call = stub.BatchStream(chatservice_pb2.StreamRequest(room=LOAD_ROOM))
+        calls.append(call)
+        threading.Thread(target=subscribe, args=(call,), daemon=True).start()
+
+    # Senders: ChatClient-style, one channel each, connected and sending one unary call at a time
+    stubs = []
+    for i in range(args.senders):
+        stub = chatservice_pb2_grpc.ChatServiceStub(grpc.insecure_channel(address))
+        stub.Connect(chatservice_pb2.PresenceRequest(username=f"sender{i}"))
+        stubs.append(stub)
+    time.sleep(0.5)  # Let the subscriptions open
+    before = server.stats()
+
+    def send(i, stub):
+        for _ in range(args.messages):
+            stub.SendMessage(chatservice_pb2.MessageRequest(
+                username=f"sender{i}", message=repr(time.perf_counter()), room=LOAD_ROOM))
+
+    started = time.perf_counter()
+    senders = [threading.Thread(target=send, args=(i, stub)) for i, stub in enumerate(stubs)]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+    send_seconds = time.perf_counter() - started
+
+    try:
+        done.wait(timeout=30)
+    except threading.BrokenBarrierError:
+        print("  some subscribers did not receive every message within 30s")
+    after = server.stats()
+    for call in calls:
+        call.cancel()
+    server.stop()
+
+    delivered = len(latencies)
+    print(f"Load: {args.senders} senders x {args.messages} messages, {args.subscribers} subscribers, {args.store} store")
+    print(f"  send throughput   {expected / send_seconds:10.0f} msg/s")
+    print(f"  delivered         {delivered:10d} of {expected * args.subscribers}")
+    if latencies:
+        print(f"  fan-out p50       {percentile(latencies, 0.5) * 1000:10.2f} ms")
+        print(f"  fan-out p99       {percentile(latencies, 0.99) * 1000:10.2f} ms")
+    print(f"  server CPU        {after['cpu_seconds'] - before['cpu_seconds']:10.2f} s")
+    print(f"  server peak RSS   {after['max_rss_mb']:10.1f} MB")
+    print(f"  dropped/resyncs   {after['streams']['dropped']:>5d} / {after['streams']['resyncs']}")
+
+
+def run_replay(args):
+    print("Replay: whole room history over BatchStream")
+    for history in args.history_sizes:
+        server = ServerProcess(args.store, history=history)
+        channel = grpc.insecure_channel(f'127.0.0.1:{server.port}')
+        stub = chatservice_pb2_grpc.ChatServiceStub(channel)
+        grpc.channel_ready_future(channel).result(timeout=10)
+
+        started = time.perf_counter()
+        call = stub.BatchStream(chatservice_pb2.StreamRequest(room=REPLAY_ROOM))
+        received = 0
+        for batch in call:
+            received += len(batch.messages)
+            if received >= history:
+                break
+        seconds = time.perf_counter() - started
+        call.cancel()
+        channel.close()
+        server.stop()
+        print(f"  {history:8d} messages {seconds:8.2f} s {history / seconds:10.0f} msg/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--store', choices=STORES, default=MEMORY)
+    parser.add_argument('--senders', type=int, default=4)
+    parser.add_argument('--subscribers', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=500, help="messages sent by each sender")
+    parser.add_argument('--history-sizes', type=int, nargs='*', default=[1000, 5000, 20000],
+                        help="room history sizes to time a full replay for, none to skip")
+    args = parser.parse_args()
+
+    run_load(args)
+    if args.history_sizes:
+        run_replay(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""Multi-node integration check for the message bus.
+
+Starts several ChatService nodes on different local ports, sharing one
+database and one LoopbackBus, then checks that:
+  - a username taken on one node can't be taken on another,
+  - messages sent to any node reach the streams of every node,
+  - every node delivers them in the same sequence order.
+
+Uses mongomock as the shared database when it is installed, otherwise a
+MongoDB on localhost:27017 (its chat_db is written to).
+
+    python benchmarks/multinode.py --nodes 3 --messages 50
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent import futures
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import grpc
+import chatservice_pb2
+import chatservice_pb2_grpc
+from bus import LoopbackBus
+from server import ChatService
+
+
+def make_mongo_client():
+    try:
+        import mongomock
+        return mongomock.MongoClient()
+    except ImportError:
+        from pymongo import MongoClient
+        return MongoClient('localhost', 27017)
+
+
+def start_node(mongo_client, bus, index):
+    chat_service = ChatService(mongo_client=mongo_client, bus=bus, node_id=f"node{index}")
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=20))
+    chatservice_pb2_grpc.add_ChatServiceServicer_to_server(chat_service, server)
+    port = server.add_insecure_port('127.0.0.1:0')
+    server.start()
+    return chat_service, server, port
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--messages', type=int, default=50, help="messages sent to each node")
+    parser.add_argument('--room', default='multinode-check')
+    args = parser.parse_args()
+
+    mongo_client = make_mongo_client()
+    bus = LoopbackBus()
+    nodes = [start_node(mongo_client, bus, i) for i in range(args.nodes)]
+    channels = [grpc.insecure_channel(f'127.0.0.1:{port}') for _, _, port in nodes]
+    stubs = [chatservice_pb2_grpc.ChatServiceStub(channel) for channel in channels]
+    print(f"Started {args.nodes} nodes on ports {[port for _, _, port in nodes]}")
+
+    failures = []
+
+    # Presence is shared: each username can only be taken once across the cluster
+    for i, stub in enumerate(stubs):
+        response = stub.Connect(chatservice_pb2.PresenceRequest(username=f"sender{i}"))
+        if response.status != chatservice_pb2.PresenceResponse.OK:
+            failures.append(f"sender{i} could not connect to node{i}")
+    for i, stub in enumerate(stubs):
+        taken = f"sender{(i + 1) % len(stubs)}"
+        response = stub.Connect(chatservice_pb2.PresenceRequest(username=taken))
+        if response.status != chatservice_pb2.PresenceResponse.USERNAME_TAKEN:
+            failures.append(f"node{i} accepted {taken}, which is connected to another node")
+
+    # One stream per node, all in the same room
+    received = [[] for _ in stubs]
+    calls = []
+    for stub, messages in zip(stubs, received):
+        call = stub.ResumeStream(chatservice_pb2.StreamRequest(room=args.room, since_seq=nodes[0][0].last_seq))
+        calls.append(call)
+
+        def read(call=call, messages=messages):
+            try:
+                for message in call:
+                    messages.append((message.seq, message.username, message.message))
+            except grpc.RpcError:
+                pass
+        threading.Thread(target=read, daemon=True).start()
+    time.sleep(0.5)
+
+    def send(i, stub):
+        for n in range(args.messages):
+            stub.SendMessage(chatservice_pb2.MessageRequest(username=f"sender{i}", message=str(n), room=args.room))
+    senders = [threading.Thread(target=send, args=(i, stub)) for i, stub in enumerate(stubs)]
+    for thread in senders:
+        thread.start()
+    for thread in senders:
+        thread.join()
+
+    expected = args.messages * len(stubs)
+    deadline = time.time() + 10
+    while time.time() < deadline and any(len(messages) < expected for messages in received):
+        time.sleep(0.1)
+
+    for i, messages in enumerate(received):
+        if len(messages) != expected:
+            failures.append(f"node{i} stream got {len(messages)} of {expected} messages")
+        if [seq for seq, _, _ in messages] != sorted(seq for seq, _, _ in messages):
+            failures.append(f"node{i} stream delivered messages out of seq order")
+        if messages != received[0]:
+            failures.append(f"node{i} stream differs from node0")
+
+    for call in calls:
+        call.cancel()
+    for channel in channels:
+        channel.close()
+    for chat_service, server, _ in nodes:
+        server.stop(0)
+        chat_service.close()
+    bus.close()
+
+    if failures:
+        print("FAILED")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"OK: {expected} messages delivered in the same order on all {args.nodes} nodes")
+
+
+if __name__ == '__main__':
+    main()
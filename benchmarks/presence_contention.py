@@ -0,0 +1,98 @@
+"""Contention micro-benchmark for the presence registry.
+
+Runs the same mix of heartbeat refreshes, connects and disconnects from
+several threads against the old single-lock dict and against the sharded
+PresenceRegistry, and prints the throughput of each.
+
+    python benchmarks/presence_contention.py --threads 8 --ops 200000
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from presence import PresenceRegistry
+
+
+class GlobalLockRegistry:
+    """The previous connected_users layout: one dict behind one lock"""
+
+    def __init__(self):
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, username):
+        with self.lock:
+            if username in self.users:
+                return False
+            self.users[username] = {'last_heartbeat': time.time()}
+            return True
+
+    def touch(self, username):
+        with self.lock:
+            user_data = self.users.get(username)
+            if user_data is None:
+                return False
+            user_data['last_heartbeat'] = time.time()
+            return True
+
+    def remove(self, username):
+        with self.lock:
+            return self.users.pop(username, None) is not None
+
+
+def worker(registry, usernames, ops, churn, barrier):
+    rng = random.Random()
+    barrier.wait()
+    for _ in range(ops):
+        username = rng.choice(usernames)
+        if rng.random() < churn:
+            # Reconnect: disconnect then claim the name again
+            registry.remove(username)
+            registry.reserve(username)
+        else:
+            registry.touch(username)
+
+
+def run(registry, threads, users, ops, churn):
+    usernames = [f"user{i}" for i in range(users)]
+    for username in usernames:
+        registry.reserve(username)
+
+    barrier = threading.Barrier(threads + 1)
+    workers = [
+        threading.Thread(target=worker, args=(registry, usernames, ops // threads, churn, barrier))
+        for _ in range(threads)
+    ]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return ops / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--ops', type=int, default=200000, help="total operations across all threads")
+    parser.add_argument('--churn', type=float, default=0.01, help="fraction of operations that reconnect")
+    parser.add_argument('--shards', type=int, default=16)
+    args = parser.parse_args()
+
+    for name, registry in [
+        ('global lock', GlobalLockRegistry()),
+        (f'sharded ({args.shards})', PresenceRegistry(shards=args.shards)),
+    ]:
+        throughput = run(registry, args.threads, args.users, args.ops, args.churn)
+        print(f"{name:>14}: {throughput:12,.0f} ops/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+import asyncio
+import queue
+import threading
+import time
+
+# What to do when a subscriber's queue is full
+DROP_OLDEST = 'drop-oldest'  # Drop the oldest queued message to make room
+DISCONNECT = 'disconnect'    # Close the subscription, the client has to resume
+RESYNC = 'resync'            # Collapse the queue into one Gap marker, the stream
+                             # then catches up from history at its own pace
+SLOW_CONSUMER_POLICIES = [DROP_OLDEST, DISCONNECT, RESYNC]
+
+
+class Gap:
+    """Queued in place of the messages a slow subscriber missed"""
+
+    def __init__(self, missed, after_seq):
+        self.missed = missed        # Number of messages dropped
+        self.after_seq = after_seq  # Resync from here, later messages may be missing
+
+
+def _collapse(items):
+    # Turn dropped queue items (messages and older gaps) into a single Gap
+    missed = sum(item.missed if isinstance(item, Gap) else 1 for item in items)
+    first = items[0]
+    after_seq = first.after_seq if isinstance(first, Gap) else first.seq - 1
+    return Gap(missed, after_seq)
+
+
+class Subscription:
+    """A single subscriber's view of one room: a bounded queue of messages"""
+
+    def __init__(self, broker, room, max_queue):
+        self.broker = broker
+        self.room = room
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.overflowed = False  # Closed by the disconnect policy
+        self.dropped = 0
+
+    def put(self, message):
+        # Never block the publisher on a slow subscriber
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.queue.put_nowait(message)
+            except queue.Full:
+                self._overflow(message)
+
+    def _overflow(self, message):
+        if self.broker.policy == DROP_OLDEST:
+            dropped = self._take(1)
+            self.queue.put_nowait(message)
+        else:
+            dropped = self._take(self.queue.maxsize) + [message]
+            if self.broker.policy == DISCONNECT:
+                self.overflowed = True
+                self._close()
+            else:
+                self.queue.put_nowait(_collapse(dropped))
+        self.broker.record_drop(self, dropped)
+
+    def _take(self, count):
+        items = []
+        while len(items) < count:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def get(self, timeout=None):
+        # Returns None on timeout or once the subscription has been closed
+        try:
+            message = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if message is _CLOSED:
+            self.closed = True
+            return None
+        return message
+
+    def get_batch(self, max_messages, window, timeout=None):
+        # Wait for one message, then keep collecting for up to window seconds
+        message = self.get(timeout)
+        if message is None:
+            return []
+        batch = [message]
+        deadline = time.monotonic() + window
+        while len(batch) < max_messages:
+            message = self.get(max(deadline - time.monotonic(), 0))
+            if message is None:
+                break
+            batch.append(message)
+        return batch
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        with self.lock:
+            if not self.closed:
+                self._close()
+
+    def _close(self):
+        # Called with self.lock held
+        self.broker.unsubscribe(self)
+        self.closed = True
+        # Wake up a consumer blocked in get(), making room if needed
+        if self.queue.full():
+            self._take(1)
+        self.queue.put_nowait(_CLOSED)
+
+
+class AsyncSubscription:
+    """Subscription consumed by a coroutine on an asyncio event loop.
+
+    Publishers run on other threads, so messages are handed to the loop
+    with call_soon_threadsafe and queued there.
+    """
+
+    def __init__(self, broker, room, max_queue, loop):
+        self.broker = broker
+        self.room = room
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.closed = False
+        self.overflowed = False
+        self.dropped = 0
+
+    def put(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The event loop has already been closed
+            pass
+
+    def _put(self, message):
+        # Runs on the event loop, so nothing else touches the queue meanwhile
+        if self.closed and message is not _CLOSED:
+            return
+        if not self.queue.full():
+            self.queue.put_nowait(message)
+        elif message is _CLOSED:
+            self._take(1)
+            self.queue.put_nowait(message)
+        elif self.broker.policy == DROP_OLDEST:
+            self.broker.record_drop(self, self._take(1))
+            self.queue.put_nowait(message)
+        else:
+            dropped = self._take(self.queue.maxsize) + [message]
+            if self.broker.policy == DISCONNECT:
+                self.overflowed = True
+                self.close()
+            else:
+                self.queue.put_nowait(_collapse(dropped))
+            self.broker.record_drop(self, dropped)
+
+    def _take(self, count):
+        items = []
+        while len(items) < count and not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    async def get(self, timeout=None):
+        try:
+            message = await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        if message is _CLOSED:
+            self.closed = True
+            return None
+        return message
+
+    async def get_batch(self, max_messages, window, timeout=None):
+        message = await self.get(timeout)
+        if message is None:
+            return []
+        batch = [message]
+        deadline = self.loop.time() + window
+        while len(batch) < max_messages:
+            if not self.queue.empty():
+                message = self.queue.get_nowait()
+                if message is _CLOSED:
+                    self.closed = True
+                    break
+            else:
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                message = await self.get(remaining)
+                if message is None:
+                    break
+            batch.append(message)
+        return batch
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def close(self):
+        if not self.closed:
+            self.broker.unsubscribe(self)
+            self.closed = True
+            self.put(_CLOSED)
+
+
+# Sentinel used to wake up a subscriber that is being closed
+_CLOSED = object()
+
+
+class MessageBroker:
+    """In-process publish/subscribe fan-out for chat messages.
+
+    Subscribers are kept per room, so publishing only touches the members
+    of the message's room. Each subscriber has a bounded queue, and
+    `policy` decides what happens when a slow one fills it up.
+    """
+
+    def __init__(self, max_queue=1000, policy=RESYNC):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.rooms = {}  # room -> set of subscriptions
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.disconnects = 0
+        self.resyncs = 0
+
+    def subscribe(self, room):
+        return self._add(Subscription(self, room, self.max_queue))
+
+    def subscribe_async(self, room, loop=None):
+        return self._add(AsyncSubscription(self, room, self.max_queue, loop or asyncio.get_running_loop()))
+
+    def _add(self, subscription):
+        with self.lock:
+            self.rooms.setdefault(subscription.room, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.rooms.get(subscription.room)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.rooms[subscription.room]
+
+    def publish(self, message):
+        # Copy the room's subscriber set so delivery happens outside the lock
+        with self.lock:
+            subscribers = list(self.rooms.get(message.room, ()))
+
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def record_drop(self, subscription, items):
+        # Messages folded into an earlier Gap were counted when it was made
+        count = sum(1 for item in items if not isinstance(item, Gap))
+        with self.lock:
+            subscription.dropped += count
+            self.dropped += count
+            if subscription.overflowed:
+                self.disconnects += 1
+            elif self.policy == RESYNC:
+                self.resyncs += 1
+
+    def subscriber_count(self, room=None):
+        with self.lock:
+            if room is not None:
+                return len(self.rooms.get(room, ()))
+            return sum(len(subscribers) for subscribers in self.rooms.values())
+
+    def stats(self):
+        with self.lock:
+            depths = [subscription.depth() for subscribers in self.rooms.values() for subscription in subscribers]
+            return {
+                'subscribers': len(depths),
+                'queued': sum(depths),
+                'max_depth': max(depths, default=0),
+                'dropped': self.dropped,
+                'disconnects': self.disconnects,
+                'resyncs': self.resyncs,
+            }
@@ -0,0 +1,265 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import chatservice_pb2
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+log = logging.getLogger(__name__)
+
+# Seconds a node waits for a missing sequence id before skipping it, e.g.
+# when the node that allocated it died before publishing
+GAP_TIMEOUT = 2.0
+# MongoDB error code when a change stream can't resume, its position has left the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+# Skipped sequence ids remembered, so they are still delivered if they turn up late
+SKIPPED_KEPT = 10000
+
+
+class SequenceReorderer:
+    """Hands messages to a callback in contiguous sequence order.
+
+    Sequence ids are allocated cluster-wide before messages are published,
+    so messages from different nodes can arrive out of order. Early arrivals
+    are held back until the gap before them is filled or has timed out.
+    A message whose gap was skipped is still handed over, late and out of
+    order, if it turns up afterwards; anything else at or below the last
+    delivered seq is dropped as a duplicate.
+    """
+
+    def __init__(self, callback, last_seq=0, gap_timeout=GAP_TIMEOUT):
+        self.callback = callback
+        self.last_seq = last_seq
+        self.gap_timeout = gap_timeout
+        self.pending = {}  # seq -> message
+        self.skipped = OrderedDict()  # seqs given up on, oldest first
+        self.gap_since = None
+        self.lock = threading.Lock()
+
+    def push(self, message):
+        with self.lock:
+            if message.seq <= self.last_seq:
+                if self.skipped.pop(message.seq, False):
+                    self.callback(message)
+                return
+            self.pending[message.seq] = message
+            self._drain()
+
+    def check_gap(self):
+        # Skip a gap that has been open for too long
+        with self.lock:
+            if self.gap_since is not None and time.monotonic() - self.gap_since > self.gap_timeout:
+                first = min(self.pending)
+                log.warning("Skipped sequence ids %d to %d after waiting %.1fs", self.last_seq + 1, first - 1,
+                            self.gap_timeout)
+                for seq in range(max(self.last_seq + 1, first - SKIPPED_KEPT), first):
+                    self.skipped[seq] = True
+                while len(self.skipped) > SKIPPED_KEPT:
+                    self.skipped.popitem(last=False)
+                self.last_seq = first - 1
+                self._drain()
+
+    def _drain(self):
+        while self.last_seq + 1 in self.pending:
+            self.last_seq += 1
+            self.callback(self.pending.pop(self.last_seq))
+        if self.pending:
+            if self.gap_since is None:
+                self.gap_since = time.monotonic()
+        else:
+            self.gap_since = None
+
+
+class MessageBus:
+    """Interface shared by every node of a chat cluster.
+
+    The bus allocates sequence ids, carries each published message to every
+    attached node (the publisher included) in seq order, and holds the
+    cluster-wide username reservations.
+    """
+
+    def attach(self, node_id, callback, last_seq):
+        """Start delivering published messages to callback, after last_seq"""
+        raise NotImplementedError
+
+    def detach(self, node_id):
+        raise NotImplementedError
+
+    def next_seq(self):
+        raise NotImplementedError
+
+    def publish(self, node_id, message):
+        raise NotImplementedError
+
+    def reserve(self, node_id, username):
+        """Claim a username cluster-wide, False if another session holds it"""
+        raise NotImplementedError
+
+    def release(self, node_id, username):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class _GapChecker:
+    # Background timer that lets the reorderers give up on stale gaps
+
+    def __init__(self, reorderers):
+        self.reorderers = reorderers
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopping.wait(GAP_TIMEOUT / 4):
+            for reorderer in list(self.reorderers()):
+                reorderer.check_gap()
+
+    def stop(self):
+        self.stopping.set()
+
+
+class LoopbackBus(MessageBus):
+    """In-process bus, for a single server or several nodes in one process"""
+
+    def __init__(self):
+        self.seq = 0
+        self.nodes = {}  # node_id -> SequenceReorderer
+        self.usernames = {}  # username -> node_id
+        self.lock = threading.Lock()
+        self.gap_checker = _GapChecker(lambda: list(self.nodes.values()))
+
+    def attach(self, node_id, callback, last_seq):
+        with self.lock:
+            self.seq = max(self.seq, last_seq)
+            self.nodes[node_id] = SequenceReorderer(callback, self.seq)
+
+    def detach(self, node_id):
+        with self.lock:
+            self.nodes.pop(node_id, None)
+            for username in [u for u, owner in self.usernames.items() if owner == node_id]:
+                del self.usernames[username]
+
+    def next_seq(self):
+        with self.lock:
+            self.seq += 1
+            return self.seq
+
+    def publish(self, node_id, message):
+        with self.lock:
+            nodes = list(self.nodes.values())
+        for reorderer in nodes:
+            reorderer.push(message)
+
+    def reserve(self, node_id, username):
+        with self.lock:
+            if username in self.usernames:
+                return False
+            self.usernames[username] = node_id
+            return True
+
+    def release(self, node_id, username):
+        with self.lock:
+            if self.usernames.get(username) == node_id:
+                del self.usernames[username]
+
+    def close(self):
+        self.gap_checker.stop()
+
+
+class MongoChangeStreamBus(MessageBus):
+    """Bus shared through MongoDB, for nodes running in separate processes.
+
+    Sequence ids come from an atomic counter document and usernames are
+    reserved in a presence collection keyed by username. Messages reach
+    other nodes through a change stream on db.messages once the publishing
+    node has written them, so MongoDB must run as a replica set.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.reorderer = None
+        self.node_id = None
+        self.stopping = threading.Event()
+        self.watch_thread = None
+        self.gap_checker = None
+
+    def attach(self, node_id, callback, last_seq):
+        # One node per bus instance, each server process builds its own
+        self.node_id = node_id
+        self.db.counters.update_one({'_id': 'messages'}, {'$max': {'seq': last_seq}}, upsert=True)
+        # Reservations left behind by a previous run of this node are stale
+        self.db.presence.delete_many({'node': node_id})
+        counter = self.db.counters.find_one({'_id': 'messages'})
+        self.reorderer = SequenceReorderer(callback, counter['seq'])
+        self.gap_checker = _GapChecker(lambda: [self.reorderer])
+
+        self.watch_thread = threading.Thread(target=self._watch, daemon=True)
+        self.watch_thread.start()
+
+    def detach(self, node_id):
+        self.db.presence.delete_many({'node': node_id})
+        self.close()
+
+    def _watch(self):
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        # Where the last stream left off, so inserts made while it was down aren't missed
+        resume_token = None
+        while not self.stopping.is_set():
+            try:
+                with self.db.messages.watch(pipeline, max_await_time_ms=500, resume_after=resume_token) as stream:
+                    while not self.stopping.is_set():
+                        change = stream.try_next()
+                        if stream.resume_token is not None:
+                            resume_token = stream.resume_token
+                        if change is None:
+                            continue
+                        doc = change['fullDocument']
+                        # Messages published by this node were delivered locally already
+                        self.reorderer.push(chatservice_pb2.MessageResponse(
+                            username=doc['user'],
+                            message=doc['message'],
+                            seq=doc['seq'],
+                            room=doc['room'],
+                        ))
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAM_HISTORY_LOST:
+                    log.error("Message bus change stream can't resume, inserts since the outage are skipped: %s", e)
+                    resume_token = None
+                else:
+                    log.warning("Message bus change stream failed: %s", e)
+                self.stopping.wait(1.0)
+            except Exception as e:
+                log.warning("Message bus change stream failed: %s", e)
+                self.stopping.wait(1.0)
+
+    def next_seq(self):
+        counter = self.db.counters.find_one_and_update(
+            {'_id': 'messages'},
+            {'$inc': {'seq': 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter['seq']
+
+    def publish(self, node_id, message):
+        # Other nodes pick the message up from the change stream once it is stored
+        self.reorderer.push(message)
+
+    def reserve(self, node_id, username):
+        try:
+            self.db.presence.insert_one({'_id': username, 'node': node_id})
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def release(self, node_id, username):
+        self.db.presence.delete_one({'_id': username, 'node': node_id})
+
+    def close(self):
+        self.stopping.set()
+        if self.gap_checker is not None:
+            self.gap_checker.stop()
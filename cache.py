@@ -0,0 +1,149 @@
+import threading
+
+
+class HistoryCache:
+    """Fixed-size ring buffer of the most recent MessageResponse objects.
+
+    Bounded both by message count and by serialized size. Every stored
+    message with a seq above `floor` is guaranteed to be in the buffer, so
+    any read starting at or above the floor can be answered without going
+    to the database.
+    """
+
+    def __init__(self, max_messages=1000, max_bytes=1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.buffer = [None] * max_messages
+        self.start = 0  # Position of the oldest message in the buffer
+        self.count = 0
+        self.size_bytes = 0
+        self.floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.warmed = False  # Set once older history has been loaded below the buffer
+        self.lock = threading.Lock()
+
+    def reset(self, messages, floor):
+        # Load a known-complete tail of the history, oldest first
+        with self.lock:
+            self.buffer = [None] * self.max_messages
+            self.start = 0
+            self.count = 0
+            self.size_bytes = 0
+            self.floor = floor
+            for message in messages:
+                self._append(message)
+
+    def prepend(self, messages, floor):
+        # Older messages read from the database up to floor, oldest first. They
+        # are dropped if the floor moved since, the read may be out of date then
+        with self.lock:
+            self.warmed = True
+            if floor != self.floor or not messages:
+                return
+            newer = [self._at(index) for index in range(self.count)]
+            self.buffer = [None] * self.max_messages
+            self.start = 0
+            self.count = 0
+            self.size_bytes = 0
+            self.floor = messages[0].seq - 1
+            for message in messages + newer:
+                self._append(message)
+
+    def append(self, message):
+        with self.lock:
+            self._append(message)
+
+    def insert(self, message):
+        # A message older than the newest one, delivered late. Below the floor
+        # it is left to the database, which holds it by now
+        with self.lock:
+            if message.seq <= self.floor:
+                return
+            index = self._first_after(message.seq - 1)
+            if index < self.count and self._at(index).seq == message.seq:
+                return
+            messages = [self._at(i) for i in range(self.count)]
+            messages.insert(index, message)
+            self.buffer = [None] * self.max_messages
+            self.start = 0
+            self.count = 0
+            self.size_bytes = 0
+            for buffered in messages:
+                self._append(buffered)
+
+    def _append(self, message):
+        if self.count == self.max_messages:
+            self._evict_oldest()
+        self.buffer[(self.start + self.count) % self.max_messages] = message
+        self.count += 1
+        self.size_bytes += message.ByteSize()
+
+        while self.size_bytes > self.max_bytes and self.count > 1:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        message = self.buffer[self.start]
+        self.buffer[self.start] = None
+        self.start = (self.start + 1) % self.max_messages
+        self.count -= 1
+        self.size_bytes -= message.ByteSize()
+        # Everything up to the evicted message now has to come from the database
+        self.floor = message.seq
+
+    def _at(self, index):
+        return self.buffer[(self.start + index) % self.max_messages]
+
+    def _first_after(self, seq):
+        # Binary search for the first buffered message with a seq above seq
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._at(middle).seq <= seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get_since(self, seq, limit=None):
+        """Messages newer than seq, or None if part of the range was evicted"""
+        with self.lock:
+            if seq < self.floor:
+                self.misses += 1
+                return None
+            self.hits += 1
+            first = self._first_after(seq)
+            last = self.count if not limit else min(self.count, first + limit)
+            return [self._at(index) for index in range(first, last)]
+
+    def get_tail(self, seq, limit):
+        """The newest limit messages after seq, or None if they are not all buffered"""
+        with self.lock:
+            first = self._first_after(seq)
+            if seq < self.floor and self.count - first < limit:
+                self.misses += 1
+                return None
+            self.hits += 1
+            first = max(first, self.count - limit)
+            return [self._at(index) for index in range(first, self.count)]
+
+    def get_before(self, seq, limit):
+        """The newest limit messages older than seq, or None if they are not all buffered"""
+        with self.lock:
+            end = self._first_after(seq - 1)
+            first = max(0, end - limit)
+            if self.floor > 0 and end - first < limit:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return [self._at(index) for index in range(first, end)]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'messages': self.count,
+                'bytes': self.size_bytes,
+                'floor': self.floor,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -0,0 +1,194 @@
+import math
+import sys
+from collections import deque
+
+import customtkinter as ctk
+
+# Rough text metrics for Helvetica 13, used to size rows without asking Tk
+CHAR_WIDTH = 8
+LINE_HEIGHT = 18
+ROW_PADDING = 24  # Bubble padding plus the gap between bubbles
+
+
+class VirtualChatView(ctk.CTkFrame):
+    """Chat message list that only builds widgets for the rows on screen.
+
+    Messages are kept as (sender, message) tuples in a bounded deque, so
+    the oldest are forgotten once max_messages is reached. A small pool of
+    row widgets is re-pointed at whichever messages are scrolled into view,
+    so the widget count depends on the window height, not on the history.
+
+    on_scroll_top, if given, is called when the user scrolls to the top so
+    older messages can be fetched and handed to prepend().
+    """
+
+    def __init__(self, master, username, max_messages=5000, wraplength=160, on_scroll_top=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.username = username
+        self.on_scroll_top = on_scroll_top
+        self.messages = deque(maxlen=max_messages)
+        self.wraplength = wraplength
+        self.first = 0  # Index of the message shown in the top row
+        self.visible = 0  # Number of rows currently on screen
+        self.follow = True  # Keep showing the newest message as more arrive
+        self.height = 0
+        self.rows = []
+
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent")
+        self.viewport.pack(side="left", fill="both", expand=True)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self._on_scrollbar)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.viewport.bind("<Configure>", self._on_resize)
+        self._bind_wheel(self.viewport)
+
+    def _bind_wheel(self, widget):
+        widget.bind("<MouseWheel>", self._on_wheel)
+        widget.bind("<Button-4>", lambda event: self.scroll_by(-1))
+        widget.bind("<Button-5>", lambda event: self.scroll_by(1))
+
+    def _make_row(self):
+        row = ctk.CTkFrame(self.viewport, fg_color="transparent")
+        row.pack_propagate(False)
+        bubble = ctk.CTkFrame(row, corner_radius=15)
+        label = ctk.CTkLabel(
+            bubble,
+            text="",
+            wraplength=self.wraplength,
+            font=("Helvetica", 13),
+            justify="left",
+            text_color="white"
+        )
+        label.pack(padx=10, pady=6)
+        for widget in (row, bubble, label):
+            self._bind_wheel(widget)
+        row.bubble = bubble
+        row.label = label
+        row.shown = None  # (sender, message) currently displayed
+        return row
+
+    def _text(self, item):
+        sender, message = item
+        return f"{'You' if sender == self.username else sender}: {message}"
+
+    def _row_height(self, item):
+        # Estimate how many lines the label wraps to
+        per_line = max(1, self.wraplength // CHAR_WIDTH)
+        lines = sum(max(1, math.ceil(len(part) / per_line)) for part in self._text(item).split("\n"))
+        return ROW_PADDING + lines * LINE_HEIGHT
+
+    def _on_resize(self, event):
+        self.height = event.height
+        if self.follow:
+            self.first = self._max_first()
+        self.render()
+
+    def _on_wheel(self, event):
+        if sys.platform == "darwin":
+            self.scroll_by(-event.delta)
+        else:
+            self.scroll_by(-int(event.delta / 120) * 3)
+
+    def _on_scrollbar(self, action, *args):
+        if action == "moveto":
+            self.scroll_to(int(float(args[0]) * len(self.messages)))
+            self._check_top()
+        elif action == "scroll":
+            count, unit = int(args[0]), args[1]
+            self.scroll_by(count * max(1, self.visible) if unit == "pages" else count)
+
+    def _check_top(self):
+        if self.first == 0 and self.messages and self.on_scroll_top is not None:
+            self.on_scroll_top()
+
+    def _max_first(self):
+        # First index of the last screenful of messages
+        used = 0
+        index = len(self.messages)
+        while index > 0:
+            used += self._row_height(self.messages[index - 1])
+            if used > self.height:
+                break
+            index -= 1
+        return index
+
+    def scroll_to(self, index):
+        last = self._max_first()
+        self.first = min(max(0, index), last)
+        self.follow = self.first == last
+        self.render()
+
+    def scroll_by(self, count):
+        self.scroll_to(self.first + count)
+        if count < 0:
+            self._check_top()
+
+    def scroll_to_bottom(self):
+        self.scroll_to(self._max_first())
+
+    def append(self, sender, message):
+        self.extend([(sender, message)])
+
+    def extend(self, messages):
+        # Messages evicted from the front shift everything that is on screen
+        overflow = max(0, len(self.messages) + len(messages) - self.messages.maxlen)
+        self.messages.extend(messages)
+        if self.follow:
+            self.first = self._max_first()
+        else:
+            self.first = max(0, self.first - overflow)
+        self.render()
+
+    def prepend(self, messages):
+        """Add older messages above the ones already shown.
+
+        Only as many as fit under max_messages are kept, newest first.
+        Returns False if some had to be left out.
+        """
+        space = self.messages.maxlen - len(self.messages)
+        kept = messages[len(messages) - space:] if len(messages) > space else messages
+        self.messages.extendleft(reversed(kept))
+        # Keep the rows on screen where they were
+        self.first = self._max_first() if self.follow else self.first + len(kept)
+        self.render()
+        return len(kept) == len(messages)
+
+    def clear(self):
+        self.messages.clear()
+        self.first = 0
+        self.follow = True
+        self.render()
+
+    def render(self):
+        # Point pooled rows at the messages from self.first down until the
+        # viewport is full, growing the pool only if the window got taller
+        y = 0
+        count = 0
+        while y < self.height and self.first + count < len(self.messages):
+            if count == len(self.rows):
+                self.rows.append(self._make_row())
+            row = self.rows[count]
+            item = self.messages[self.first + count]
+            height = self._row_height(item)
+            if row.shown != item:
+                is_you = item[0] == self.username
+                row.bubble.configure(fg_color="#3b82f6" if is_you else "#4b5563")  # blue / gray
+                row.label.configure(text=self._text(item))
+                row.bubble.pack_forget()
+                row.bubble.pack(pady=5, padx=10, anchor="w" if is_you else "e")
+                row.shown = item
+            row.configure(height=height)
+            row.place(x=0, y=y, relwidth=1.0)
+            y += height
+            count += 1
+
+        for row in self.rows[count:]:
+            row.place_forget()
+            row.shown = None
+        self.visible = count
+
+        total = len(self.messages)
+        if total:
+            self.scrollbar.set(self.first / total, (self.first + count) / total)
+        else:
+            self.scrollbar.set(0.0, 1.0)
@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x11\x63hatservice.proto\"3\n\x0eMessageRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\"4\n\x0fMessageResponse\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\"\x07\n\x05\x45mpty2k\n\x0b\x43hatService\x12\x32\n\x0bSendMessage\x12\x0f.MessageRequest\x1a\x10.MessageResponse\"\x00\x12(\n\nChatStream\x12\x06.Empty\x1a\x10.MessageResponse0\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x11\x63hatservice.proto\"U\n\x0eMessageRequest\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x0c\n\x04room\x18\x03 \x01(\t\x12\x12\n\nrequest_id\x18\x04 \x01(\x04\"O\n\x0fMessageResponse\x12\x10\n\x08username\x18\x01 \x01(\t\x12\x0f\n\x07message\x18\x02 \x01(\t\x12\x0b\n\x03seq\x18\x03 \x01(\x03\x12\x0c\n\x04room\x18\x04 \x01(\t\"q\n\rStreamRequest\x12\x11\n\tsince_seq\x18\x01 \x01(\x03\x12\x13\n\x0bmax_backlog\x18\x02 \x01(\x05\x12\x0c\n\x04room\x18\x03 \x01(\t\x12\x17\n\x0f\x62\x61tch_window_ms\x18\x04 \x01(\x05\x12\x11\n\tmax_batch\x18\x05 \x01(\x05\"A\n\x0eHistoryRequest\x12\x0c\n\x04room\x18\x01 \x01(\t\x12\x12\n\nbefore_seq\x18\x02 \x01(\x03\x12\r\n\x05limit\x18\x03 \x01(\x05\"\xac\x01\n\x07SendAck\x12\x12\n\nrequest_id\x18\x01 \x01(\x04\x12\x1f\n\x06status\x18\x02 \x01(\x0e\x32\x0f.SendAck.Status\x12\x0b\n\x03seq\x18\x03 \x01(\x03\x12\x16\n\x0eretry_after_ms\x18\x04 \x01(\x05\"G\n\x06Status\x12\x06\n\x02OK\x10\x00\x12\x11\n\rNOT_CONNECTED\x10\x01\x12\n\n\x06\x46\x41ILED\x10\x02\x12\x16\n\x12RESOURCE_EXHAUSTED\x10\x03\"2\n\x0cMessageBatch\x12\"\n\x08messages\x18\x01 \x03(\x0b\x32\x10.MessageResponse\"#\n\x0fPresenceRequest\x12\x10\n\x08username\x18\x01 \x01(\t\"\x93\x01\n\x10PresenceResponse\x12(\n\x06status\x18\x01 \x01(\x0e\x32\x18.PresenceResponse.Status\x12\x1c\n\x14heartbeat_timeout_ms\x18\x02 \x01(\x05\"7\n\x06Status\x12\x06\n\x02OK\x10\x00\x12\x12\n\x0eUSERNAME_TAKEN\x10\x01\x12\x11\n\rNOT_CONNECTED\x10\x02\"\x07\n\x05\x45mpty2\xf5\x03\n\x0b\x43hatService\x12\x32\n\x0bSendMessage\x12\x0f.MessageRequest\x1a\x10.MessageResponse\"\x00\x12+\n\nSendStream\x12\x0f.MessageRequest\x1a\x08.SendAck(\x01\x30\x01\x12(\n\nChatStream\x12\x06.Empty\x1a\x10.MessageResponse0\x01\x12\x32\n\x0cResumeStream\x12\x0e.StreamRequest\x1a\x10.MessageResponse0\x01\x12.\n\x0b\x42\x61tchStream\x12\x0e.StreamRequest\x1a\r.MessageBatch0\x01\x12,\n\nGetHistory\x12\x0f.HistoryRequest\x1a\r.MessageBatch\x12.\n\x07\x43onnect\x12\x10.PresenceRequest\x1a\x11.PresenceResponse\x12\x30\n\tHeartbeat\x12\x10.PresenceRequest\x1a\x11.PresenceResponse\x12\x31\n\nDisconnect\x12\x10.PresenceRequest\x1a\x11.PresenceResponse\x12\x34\n\tKeepAlive\x12\x10.PresenceRequest\x1a\x11.PresenceResponse(\x01\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,11 +32,27 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chatservice_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_MESSAGEREQUEST']._serialized_start=21
-  _globals['_MESSAGEREQUEST']._serialized_end=72
-  _globals['_MESSAGERESPONSE']._serialized_start=74
-  _globals['_MESSAGERESPONSE']._serialized_end=126
-  _globals['_EMPTY']._serialized_start=128
-  _globals['_EMPTY']._serialized_end=135
-  _globals['_CHATSERVICE']._serialized_start=137
-  _globals['_CHATSERVICE']._serialized_end=244
+  _globals['_MESSAGEREQUEST']._serialized_end=106
+  _globals['_MESSAGERESPONSE']._serialized_start=108
+  _globals['_MESSAGERESPONSE']._serialized_end=187
+  _globals['_STREAMREQUEST']._serialized_start=189
+  _globals['_STREAMREQUEST']._serialized_end=302
+  _globals['_HISTORYREQUEST']._serialized_start=304
+  _globals['_HISTORYREQUEST']._serialized_end=369
+  _globals['_SENDACK']._serialized_start=372
+  _globals['_SENDACK']._serialized_end=544
+  _globals['_SENDACK_STATUS']._serialized_start=473
+  _globals['_SENDACK_STATUS']._serialized_end=544
+  _globals['_MESSAGEBATCH']._serialized_start=546
+  _globals['_MESSAGEBATCH']._serialized_end=596
+  _globals['_PRESENCEREQUEST']._serialized_start=598
+  _globals['_PRESENCEREQUEST']._serialized_end=633
+  _globals['_PRESENCERESPONSE']._serialized_start=636
+  _globals['_PRESENCERESPONSE']._serialized_end=783
+  _globals['_PRESENCERESPONSE_STATUS']._serialized_start=728
+  _globals['_PRESENCERESPONSE_STATUS']._serialized_end=783
+  _globals['_EMPTY']._serialized_start=785
+  _globals['_EMPTY']._serialized_end=792
+  _globals['_CHATSERVICE']._serialized_start=795
+  _globals['_CHATSERVICE']._serialized_end=1296
 # @@protoc_insertion_point(module_scope)
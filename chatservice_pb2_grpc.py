@@ -39,11 +39,51 @@ class ChatServiceStub(object):
                 request_serializer=chatservice__pb2.MessageRequest.SerializeToString,
                 response_deserializer=chatservice__pb2.MessageResponse.FromString,
                 _registered_method=True)
+        self.SendStream = channel.stream_stream(
+                '/ChatService/SendStream',
+                request_serializer=chatservice__pb2.MessageRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.SendAck.FromString,
+                _registered_method=True)
         self.ChatStream = channel.unary_stream(
                 '/ChatService/ChatStream',
                 request_serializer=chatservice__pb2.Empty.SerializeToString,
                 response_deserializer=chatservice__pb2.MessageResponse.FromString,
                 _registered_method=True)
+        self.ResumeStream = channel.unary_stream(
+                '/ChatService/ResumeStream',
+                request_serializer=chatservice__pb2.StreamRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.MessageResponse.FromString,
+                _registered_method=True)
+        self.BatchStream = channel.unary_stream(
+                '/ChatService/BatchStream',
+                request_serializer=chatservice__pb2.StreamRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.MessageBatch.FromString,
+                _registered_method=True)
+        self.GetHistory = channel.unary_unary(
+                '/ChatService/GetHistory',
+                request_serializer=chatservice__pb2.HistoryRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.MessageBatch.FromString,
+                _registered_method=True)
+        self.Connect = channel.unary_unary(
+                '/ChatService/Connect',
+                request_serializer=chatservice__pb2.PresenceRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.PresenceResponse.FromString,
+                _registered_method=True)
+        self.Heartbeat = channel.unary_unary(
+                '/ChatService/Heartbeat',
+                request_serializer=chatservice__pb2.PresenceRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.PresenceResponse.FromString,
+                _registered_method=True)
+        self.Disconnect = channel.unary_unary(
+                '/ChatService/Disconnect',
+                request_serializer=chatservice__pb2.PresenceRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.PresenceResponse.FromString,
+                _registered_method=True)
+        self.KeepAlive = channel.stream_stream(
+                '/ChatService/KeepAlive',
+                request_serializer=chatservice__pb2.PresenceRequest.SerializeToString,
+                response_deserializer=chatservice__pb2.PresenceResponse.FromString,
+                _registered_method=True)
 
 
 class ChatServiceServicer(object):
@@ -55,12 +95,67 @@ class ChatServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendStream(self, request_iterator, context):
+        """Pipelined sending: one ack per request, in request order
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ChatStream(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ResumeStream(self, request, context):
+        """Sends only messages after since_seq, then switches to live push
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BatchStream(self, request, context):
+        """Same as ResumeStream, but messages are coalesced into batches
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def GetHistory(self, request, context):
+        """One page of older messages, for clients that load history on demand
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Connect(self, request, context):
+        """Presence, kept out of SendMessage so it needs no metadata or string parsing
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Heartbeat(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def Disconnect(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def KeepAlive(self, request_iterator, context):
+        """One long-lived stream per client, each request is a heartbeat and
+        closing the stream disconnects the user
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_ChatServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -69,11 +164,51 @@ def add_ChatServiceServicer_to_server(servicer, server):
                     request_deserializer=chatservice__pb2.MessageRequest.FromString,
                     response_serializer=chatservice__pb2.MessageResponse.SerializeToString,
             ),
+            'SendStream': grpc.stream_stream_rpc_method_handler(
+                    servicer.SendStream,
+                    request_deserializer=chatservice__pb2.MessageRequest.FromString,
+                    response_serializer=chatservice__pb2.SendAck.SerializeToString,
+            ),
             'ChatStream': grpc.unary_stream_rpc_method_handler(
                     servicer.ChatStream,
                     request_deserializer=chatservice__pb2.Empty.FromString,
                     response_serializer=chatservice__pb2.MessageResponse.SerializeToString,
             ),
+            'ResumeStream': grpc.unary_stream_rpc_method_handler(
+                    servicer.ResumeStream,
+                    request_deserializer=chatservice__pb2.StreamRequest.FromString,
+                    response_serializer=chatservice__pb2.MessageResponse.SerializeToString,
+            ),
+            'BatchStream': grpc.unary_stream_rpc_method_handler(
+                    servicer.BatchStream,
+                    request_deserializer=chatservice__pb2.StreamRequest.FromString,
+                    response_serializer=chatservice__pb2.MessageBatch.SerializeToString,
+            ),
+            'GetHistory': grpc.unary_unary_rpc_method_handler(
+                    servicer.GetHistory,
+                    request_deserializer=chatservice__pb2.HistoryRequest.FromString,
+                    response_serializer=chatservice__pb2.MessageBatch.SerializeToString,
+            ),
+            'Connect': grpc.unary_unary_rpc_method_handler(
+                    servicer.Connect,
+                    request_deserializer=chatservice__pb2.PresenceRequest.FromString,
+                    response_serializer=chatservice__pb2.PresenceResponse.SerializeToString,
+            ),
+            'Heartbeat': grpc.unary_unary_rpc_method_handler(
+                    servicer.Heartbeat,
+                    request_deserializer=chatservice__pb2.PresenceRequest.FromString,
+                    response_serializer=chatservice__pb2.PresenceResponse.SerializeToString,
+            ),
+            'Disconnect': grpc.unary_unary_rpc_method_handler(
+                    servicer.Disconnect,
+                    request_deserializer=chatservice__pb2.PresenceRequest.FromString,
+                    response_serializer=chatservice__pb2.PresenceResponse.SerializeToString,
+            ),
+            'KeepAlive': grpc.stream_stream_rpc_method_handler(
+                    servicer.KeepAlive,
+                    request_deserializer=chatservice__pb2.PresenceRequest.FromString,
+                    response_serializer=chatservice__pb2.PresenceResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'ChatService', rpc_method_handlers)
@@ -112,6 +247,33 @@ class ChatService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def SendStream(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/ChatService/SendStream',
+            chatservice__pb2.MessageRequest.SerializeToString,
+            chatservice__pb2.SendAck.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
     @staticmethod
     def ChatStream(request,
             target,
@@ -138,3 +300,192 @@ class ChatService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def ResumeStream(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/ChatService/ResumeStream',
+            chatservice__pb2.StreamRequest.SerializeToString,
+            chatservice__pb2.MessageResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def BatchStream(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/ChatService/BatchStream',
+            chatservice__pb2.StreamRequest.SerializeToString,
+            chatservice__pb2.MessageBatch.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def GetHistory(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/ChatService/GetHistory',
+            chatservice__pb2.HistoryRequest.SerializeToString,
+            chatservice__pb2.MessageBatch.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Connect(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/ChatService/Connect',
+            chatservice__pb2.PresenceRequest.SerializeToString,
+            chatservice__pb2.PresenceResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Heartbeat(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/ChatService/Heartbeat',
+            chatservice__pb2.PresenceRequest.SerializeToString,
+            chatservice__pb2.PresenceResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def Disconnect(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/ChatService/Disconnect',
+            chatservice__pb2.PresenceRequest.SerializeToString,
+            chatservice__pb2.PresenceResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def KeepAlive(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_stream(
+            request_iterator,
+            target,
+            '/ChatService/KeepAlive',
+            chatservice__pb2.PresenceRequest.SerializeToString,
+            chatservice__pb2.PresenceResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
@@ -1,93 +1,432 @@
 import grpc
 import chatservice_pb2
 import chatservice_pb2_grpc
-from google.protobuf.empty_pb2 import Empty
 
+import itertools
+import os
+import queue
+import random
 import sys
 import threading
 import time
+from collections import deque
+from concurrent.futures import Future
+
+from client_cache import MessageCache
+from transport import RETRY_AFTER_KEY, TransportConfig
+
+SERVER_ADDRESS = 'localhost:50051'
+# Received messages are kept here so the next start only fetches what is new
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cs4459_chat_cache.sqlite3")
+# Messages kept on disk per server and room
+CACHE_SIZE = 5000
+# A message refused with RESOURCE_EXHAUSTED is retried this many times,
+# waiting at least as long as the server asks and doubling each time
+SEND_RETRIES = 5
+SEND_BACKOFF = 0.25
+SEND_BACKOFF_MAX = 8
+# Heartbeat timeout assumed until the server tells us its own
+DEFAULT_HEARTBEAT_TIMEOUT = 15
+# Heartbeats sent per server heartbeat timeout, so one late or lost beat doesn't drop us
+HEARTBEATS_PER_TIMEOUT = 3
+# Reconnect attempts wait a random time up to this, doubled after each failure
+RECONNECT_BACKOFF = 0.5
+RECONNECT_BACKOFF_MAX = 30
+
+
+def retry_after(error):
+    # Seconds the server asked us to wait before retrying, 0 if it didn't say
+    for key, value in error.trailing_metadata() or ():
+        if key == RETRY_AFTER_KEY:
+            return int(value) / 1000
+    return 0
+
+
+class ConnectionManager:
+    """Keeps a ChatClient's presence on the server alive.
+
+    One scheduler thread sends a heartbeat when nothing else has reached
+    the server for a third of the server's heartbeat timeout; sent messages
+    refresh presence too, so an active user sends no heartbeats at all.
+    When a heartbeat or the message stream fails, it reconnects with
+    exponential backoff and full jitter, and sets `online` once the user is
+    back, for the stream to resume from the last seq it received.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.heartbeat_timeout = DEFAULT_HEARTBEAT_TIMEOUT
+        self.last_activity = 0.0  # monotonic time the server last heard from us
+        self.online = threading.Event()
+        self.failures = 0  # Losses and failed attempts since the connection last held up
+        self.next_attempt = 0.0
+        self.wakeup = threading.Condition()
+        self.stopping = False
+        self.thread = None
+
+    @property
+    def heartbeat_interval(self):
+        return self.heartbeat_timeout / HEARTBEATS_PER_TIMEOUT
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.wakeup:
+            self.stopping = True
+            self.online.clear()
+            self.wakeup.notify()
+
+    def connected(self, response):
+        # The server accepted us, response is its PresenceResponse
+        if response.heartbeat_timeout_ms:
+            self.heartbeat_timeout = response.heartbeat_timeout_ms / 1000
+        with self.wakeup:
+            self.online.set()
+            self.wakeup.notify()
+        self.touch()
+
+    def touch(self):
+        # Something the server counts as a heartbeat got through
+        self.last_activity = time.monotonic()
+
+    def lost(self):
+        # Called when a call fails in a way that suggests we are disconnected
+        with self.wakeup:
+            if self.stopping or not self.online.is_set():
+                return
+            self.failures += 1
+            self.online.clear()
+            self._schedule_attempt()
+            self.wakeup.notify()
+        self.client.notify("Connection to server lost, reconnecting...")
+
+    def _schedule_attempt(self):
+        # Full jitter: a random wait up to the backoff, so clients cut off
+        # together don't all come back at the same moment
+        backoff = min(RECONNECT_BACKOFF_MAX, RECONNECT_BACKOFF * 2 ** self.failures)
+        self.next_attempt = time.monotonic() + random.uniform(0, backoff)
+
+    def _run(self):
+        while True:
+            with self.wakeup:
+                if self.stopping:
+                    return
+                if self.online.is_set():
+                    due = self.last_activity + self.heartbeat_interval
+                else:
+                    due = self.next_attempt
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.wakeup.wait(delay)
+                    continue  # Re-check, activity may have pushed the deadline back
+                online = self.online.is_set()
+            if online:
+                self._heartbeat()
+            else:
+                self._reconnect()
+
+    def _heartbeat(self):
+        request = chatservice_pb2.PresenceRequest(username=self.client.username)
+        try:
+            response = self.client.stub.Heartbeat(request, timeout=self.heartbeat_interval)
+        except grpc.RpcError:
+            self.lost()
+            return
+        if response.status == chatservice_pb2.PresenceResponse.OK:
+            self.failures = 0  # Stayed connected, the next loss starts the backoff over
+            self.touch()
+        else:
+            self.lost()  # The server dropped us, e.g. after a restart
+
+    def _reconnect(self):
+        request = chatservice_pb2.PresenceRequest(username=self.client.username)
+        try:
+            # Still known to the server if only the stream broke, else connect again
+            response = self.client.stub.Heartbeat(request, timeout=self.heartbeat_interval)
+            if response.status == chatservice_pb2.PresenceResponse.NOT_CONNECTED:
+                response = self.client.stub.Connect(request, timeout=self.heartbeat_interval)
+        except grpc.RpcError:
+            self.failures += 1
+            self._schedule_attempt()
+            return
+
+        if response.status == chatservice_pb2.PresenceResponse.OK:
+            self.connected(response)
+            self.client.notify("Reconnected to server.")
+        else:
+            # Someone else took the username while we were away
+            self.stop()
+            self.client.notify("Could not reconnect, the username is taken.")
+
 
 class ChatClient:
-    def __init__(self, username, on_message_callback=None):
-        self.channel = grpc.insecure_channel('localhost:50051')
+    def __init__(self, username, on_message_callback=None, max_backlog=0, room="", cache_path=None, cache_size=CACHE_SIZE,
+                 transport=None, on_reset_callback=None):
+        self.server_address = SERVER_ADDRESS
+        transport = transport or TransportConfig()
+        self.channel = grpc.insecure_channel(self.server_address, options=transport.channel_options())
         self.stub = chatservice_pb2_grpc.ChatServiceStub(self.channel)
         self.username = username
         self.stop_event = threading.Event()
         self.receive_thread = None
-        self.heartbeat_thread = None
         self.input_buffer = ""
         self.on_message_callback = on_message_callback
-        self.connected = False
+        # Called when the messages received so far are stale and have to be dropped
+        self.on_reset_callback = on_reset_callback
         self.is_closing = False
+        # Heartbeats and reconnects
+        self.connection = ConnectionManager(self)
+        # Last sequence id received, so a new stream only fetches what we missed
+        self.last_seq = 0
+        # Oldest sequence id received, older history is fetched a page at a time
+        self.first_seq = 0
+        self.history_complete = False
+        self.max_backlog = max_backlog
+        self.room = room  # Empty for the server's default room
+        # Optional on-disk cache of received messages
+        self.cache = MessageCache(cache_path, cache_size) if cache_path else None
+
+        # Pipelined sending over one SendStream, see send_async
+        self.send_lock = threading.Lock()
+        self.send_queue = None  # Requests for the open SendStream, None if there is none
+        self.request_ids = itertools.count(1)
+
+    @property
+    def connected(self):
+        return self.connection.online.is_set()
+
+    def notify(self, message):
+        # Show a System message, unless we are shutting down
+        if self.on_message_callback and not self.is_closing:
+            self.on_message_callback("System", message)
 
     def send_message(self, message):
         try:
-            message_request = chatservice_pb2.MessageRequest(username=self.username, message=message)
-            response = self.stub.SendMessage(message_request)
-            
+            message_request = chatservice_pb2.MessageRequest(username=self.username, message=message, room=self.room)
+            response = self._send_with_backoff(message_request)
+            if response is None:
+                if self.on_message_callback:
+                    self.on_message_callback("System", "Server busy, message not sent.")
+                return False
+
             # Check if server responded with an error about not being connected
             if response.username == "System" and "not connected" in response.message.lower():
-                self.connected = False
-                if self.on_message_callback:
-                    self.on_message_callback("System", "You are not connected to the server.")
+                self.notify("You are not connected to the server.")
+                self.connection.lost()
                 return False
-                
+
+            # The server refreshed our presence, no heartbeat needed for a while
+            self.connection.touch()
             return True
-        except grpc.RpcError:
-            self.connected = False
-            if self.on_message_callback and not self.is_closing:
-                self.on_message_callback("System", "Server error. Cannot send message.")
+        except grpc.RpcError as e:
+            self.notify("Server error. Cannot send message.")
+            if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+                self.connection.lost()
             return False
 
-    def send_heartbeat(self):
-        """Send periodic heartbeats to server"""
+    def _send_with_backoff(self, message_request):
+        # The SendMessage response, None if the server stayed too busy to take it
+        delay = SEND_BACKOFF
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                return self.stub.SendMessage(message_request)
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.RESOURCE_EXHAUSTED:
+                    raise
+                if attempt == SEND_RETRIES:
+                    return None
+                # Jitter keeps clients refused together from retrying together
+                if self.stop_event.wait(max(retry_after(e), delay) * random.uniform(1, 1.5)):
+                    return None
+                delay = min(delay * 2, SEND_BACKOFF_MAX)
+
+    def send_async(self, message):
+        """Send a message without waiting for the server.
+
+        Returns a Future resolved with the message's SendAck. Many messages
+        can be in flight at once, the server acks them in send order. A
+        RESOURCE_EXHAUSTED ack means the message was not saved; it says in
+        retry_after_ms how long to wait before sending more.
+        """
+        future = Future()
+        request = chatservice_pb2.MessageRequest(
+            username=self.username,
+            message=message,
+            room=self.room,
+            request_id=next(self.request_ids),
+        )
+        with self.send_lock:
+            if self.send_queue is None:
+                self._open_send_stream()
+            self.send_queue.put((request, future))
+        return future
+
+    def _open_send_stream(self):
+        # Called with send_lock held. Each stream has its own request queue and
+        # its own deque of futures waiting for an ack, in send order
+        send_queue = queue.Queue()
+        pending_acks = deque()
+        self.send_queue = send_queue
+        acks = self.stub.SendStream(self._send_requests(send_queue, pending_acks))
+        threading.Thread(target=self._receive_acks, args=(send_queue, pending_acks, acks), daemon=True).start()
+
+    def _send_requests(self, send_queue, pending_acks):
+        while True:
+            item = send_queue.get()
+            if item is None:
+                return
+            request, future = item
+            with self.send_lock:
+                # Queued before the request goes out, so acks always find their future
+                closed = self.send_queue is not send_queue
+                if not closed:
+                    pending_acks.append(future)
+            if closed:
+                # The stream ended while this request was being taken off the queue
+                future.set_exception(ConnectionError("Send stream closed"))
+                return
+            yield request
+
+    def _receive_acks(self, send_queue, pending_acks, acks):
+        error = None
+        try:
+            for ack in acks:
+                if ack.status == chatservice_pb2.SendAck.OK:
+                    self.connection.touch()
+                pending_acks.popleft().set_result(ack)
+        except grpc.RpcError as e:
+            error = e
+        finally:
+            with self.send_lock:
+                if self.send_queue is send_queue:
+                    self.send_queue = None
+                unacked = list(pending_acks)
+                pending_acks.clear()
+            # Anything still unacknowledged is failed, the next send opens a new stream
+            error = error or ConnectionError("Send stream closed")
+            for future in unacked:
+                future.set_exception(error)
+            while not send_queue.empty():
+                item = send_queue.get_nowait()
+                if item is not None:
+                    item[1].set_exception(error)
+            # Ends _send_requests if it is still waiting for a request
+            send_queue.put(None)
+
+    def _show_cached(self):
+        # Show the cached tail straight away, the stream then only sends newer messages
+        limit = self.max_backlog or self.cache.max_messages
+        cached = self.cache.tail(self.server_address, self.room, limit)
+        for seq, username, message in cached:
+            if self.on_message_callback:
+                self.on_message_callback(username, message)
+        if cached:
+            self.first_seq = cached[0][0]
+            self.last_seq = cached[-1][0]
+
+    def receive_messages(self):
+        if self.cache is not None and not self.last_seq:
+            self._show_cached()
+        # Each time the stream breaks, wait for the connection manager to get
+        # us back online and resume after the last message received. Without
+        # a connection (read-only use) the stream is opened just once
+        managed = self.connection.thread is not None
         while not self.stop_event.is_set():
+            if managed and not self.connection.online.wait(timeout=1):
+                continue
             try:
-                if self.connected and not self.is_closing:
-                    message_request = chatservice_pb2.MessageRequest(username=self.username, message="")
-                    metadata = [('message-type', 'heartbeat')]
-                    response = self.stub.SendMessage(message_request, metadata=metadata)
-                    
-                    # Check if server indicates we're not connected
-                    if "ERROR:" in response.message:
-                        self.connected = False
-                        if self.on_message_callback:
-                            self.on_message_callback("System", "Connection to server lost")
-                        break
-            except grpc.RpcError:
-                # If we can't send heartbeats, the connection might be down
-                if not self.is_closing and self.connected:
-                    self.connected = False
-                    if self.on_message_callback:
-                        self.on_message_callback("System", "Connection to server lost")
+                self._receive_stream()
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.OUT_OF_RANGE:
+                    # The server no longer has the messages we resumed after
+                    self._reset_history()
+                    continue
+                if not managed:
+                    self.notify("Connection to server lost")
+            if not managed:
                 break
+            if not self.stop_event.is_set():
+                self.connection.lost()
 
-            time.sleep(15)  # Send heartbeat every 15 seconds
+    def _reset_history(self):
+        self._drop_history()
+        self.notify("The server's history was reset, reloading messages.")
+
+    def _drop_history(self):
+        # Forget every message received, the next stream starts from the newest ones
+        self.last_seq = 0
+        self.first_seq = 0
+        self.history_complete = False
+        if self.cache is not None:
+            self.cache.clear(self.server_address, self.room)
+        if self.on_reset_callback:
+            self.on_reset_callback()
+
+    def _missed_more_than_backlog(self):
+        # True if at least max_backlog messages came after last_seq, judged by the
+        # room's newest max_backlog. A backlog above the server's page size is
+        # never confirmed, those clients replay the whole gap
+        history_request = chatservice_pb2.HistoryRequest(room=self.room, limit=self.max_backlog)
+        newest = self.stub.GetHistory(history_request).messages
+        return len(newest) == self.max_backlog and newest[0].seq > self.last_seq
+
+    def _receive_stream(self):
+        # Resuming after a known message fetches everything missed, unless that
+        # is more than max_backlog: then the old messages are dropped and the
+        # stream starts like a first join, older ones are paged in on demand
+        if self.last_seq and self.max_backlog and self._missed_more_than_backlog():
+            self._drop_history()
+        stream_request = chatservice_pb2.StreamRequest(
+            since_seq=self.last_seq,
+            max_backlog=0 if self.last_seq else self.max_backlog,
+            room=self.room,
+        )
+        # Messages arrive in batches, large ones while catching up
+        for batch in self.stub.BatchStream(stream_request):
+            if self.stop_event.is_set():
+                break
+            if self.cache is not None:
+                self.cache.add(self.server_address, self.room, batch.messages)
+
+            for message in batch.messages:
+                if message.seq:
+                    # A message delivered late has a lower seq than the ones before it
+                    self.last_seq = max(self.last_seq, message.seq)
+                    if not self.first_seq:
+                        self.first_seq = message.seq
 
-    def receive_messages(self):
-        try:
-            for message in self.stub.ChatStream(Empty()):
-                if self.stop_event.is_set():
-                    break
-                
                 if message.username != "System" or "ERROR:" in message.message:
                     if self.on_message_callback:
                         self.on_message_callback(message.username, message.message)
+
+    def load_older(self, limit=100):
+        """Fetch the page of history just before the oldest message received.
+
+        Returns (username, message) pairs, oldest first. history_complete is
+        set once the start of the room has been reached.
+        """
+        if self.history_complete or not self.first_seq:
+            return []
+        try:
+            history_request = chatservice_pb2.HistoryRequest(room=self.room, before_seq=self.first_seq, limit=limit)
+            batch = self.stub.GetHistory(history_request)
         except grpc.RpcError:
-            if not self.is_closing and self.connected:
-                self.connected = False
-                if self.on_message_callback:
-                    self.on_message_callback("System", "Connection to server lost")
+            return []
+
+        if len(batch.messages) < limit:
+            self.history_complete = True
+        if batch.messages:
+            self.first_seq = batch.messages[0].seq
+        return [(message.username, message.message) for message in batch.messages]
 
     def start_chat(self):
         self.receive_thread = threading.Thread(target=self.receive_messages)
         self.receive_thread.daemon = True
         self.receive_thread.start()
 
-        self.heartbeat_thread = threading.Thread(target=self.send_heartbeat)
-        self.heartbeat_thread.daemon = True
-        self.heartbeat_thread.start()
-        
         try:
             while True:
                 self.input_buffer = input("> ")
@@ -104,20 +443,17 @@ class ChatClient:
             print("\nExiting chat")
         finally:
             self.stop_event.set()
+            self.connection.stop()
             self.channel.close()
 
     def check_username_available(self):
         try:
-            connect_request = chatservice_pb2.MessageRequest(username=self.username, message="")
+            connect_request = chatservice_pb2.PresenceRequest(username=self.username)
+            response = self.stub.Connect(connect_request)
 
-            metadata = [('message-type', 'connect')]
-            response = self.stub.SendMessage(connect_request, metadata=metadata)
-
-            if response.message.startswith("SUCCESS"):
-                self.connected = True
-                self.heartbeat_thread = threading.Thread(target=self.send_heartbeat)
-                self.heartbeat_thread.daemon = True
-                self.heartbeat_thread.start()
+            if response.status == chatservice_pb2.PresenceResponse.OK:
+                self.connection.connected(response)
+                self.connection.start()
                 return True
             return False
         except grpc.RpcError as e:
@@ -127,20 +463,21 @@ class ChatClient:
             return False
     
     def disconnect(self):
-        if self.connected:
+        was_connected = self.connected
+        self.connection.stop()
+        if was_connected:
             try:
-                disconnect_request = chatservice_pb2.MessageRequest(username=self.username, message="")
-                metadata = [('message-type', 'disconnect')]
-
-                self.stub.SendMessage(disconnect_request, metadata=metadata)
+                disconnect_request = chatservice_pb2.PresenceRequest(username=self.username)
+                self.stub.Disconnect(disconnect_request)
             except grpc.RpcError:
                 pass
-            finally:
-                self.connected = False
 
     def close(self):
         self.is_closing = True
         self.stop_event.set()
+        with self.send_lock:
+            if self.send_queue is not None:
+                self.send_queue.put(None)
         try:
             self.disconnect()
         except Exception:
@@ -153,7 +490,7 @@ class ChatClient:
 if __name__ == "__main__":
     try:
         username = input("Enter your username: ")
-        client = ChatClient(username)
+        client = ChatClient(username, cache_path=DEFAULT_CACHE_PATH)
 
         if client.check_username_available():
             print('Welcome!')
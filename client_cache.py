@@ -0,0 +1,58 @@
+import sqlite3
+import threading
+
+
+class MessageCache:
+    """On-disk copy of recently received messages, kept in a SQLite file.
+
+    Messages are keyed by server address and room, so one file can serve
+    several servers and rooms. Each (server, room) keeps at most
+    max_messages, the oldest are deleted as new ones arrive.
+    """
+
+    def __init__(self, path, max_messages=5000):
+        self.max_messages = max_messages
+        self.lock = threading.Lock()
+        # Written by the receive thread, read by whoever starts the client
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                server TEXT NOT NULL,
+                room TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                message TEXT NOT NULL,
+                PRIMARY KEY (server, room, seq)
+            ) WITHOUT ROWID
+        """)
+        self.db.commit()
+
+    def tail(self, server, room, limit):
+        """The newest limit cached messages as (seq, username, message), oldest first"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT seq, username, message FROM messages WHERE server = ? AND room = ? "
+                "ORDER BY seq DESC LIMIT ?",
+                (server, room, limit),
+            ).fetchall()
+        return rows[::-1]
+
+    def clear(self, server, room):
+        with self.lock:
+            self.db.execute("DELETE FROM messages WHERE server = ? AND room = ?", (server, room))
+            self.db.commit()
+
+    def add(self, server, room, messages):
+        # One transaction per received batch
+        rows = [(server, room, message.seq, message.username, message.message) for message in messages if message.seq]
+        if not rows:
+            return
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)", rows)
+            # Evict everything older than the newest max_messages of this room
+            self.db.execute(
+                "DELETE FROM messages WHERE server = ? AND room = ? AND seq <= ("
+                "SELECT seq FROM messages WHERE server = ? AND room = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (server, room, server, room, self.max_messages),
+            )
+            self.db.commit()
@@ -1,5 +1,7 @@
+import queue
 import threading
-from client import ChatClient
+from chat_view import VirtualChatView
+from client import ChatClient, DEFAULT_CACHE_PATH
 # import tkinter as tk
 # from tkinter import ttk
 # from tkinter.scrolledtext import ScrolledText
@@ -8,17 +10,39 @@ import customtkinter as ctk
 import tkinter.messagebox as mb 
 from customtkinter import CTkInputDialog
 
+# Messages kept in the chat view, older ones are forgotten
+MAX_RETAINED_MESSAGES = 5000
+# Received messages are applied to the view in batches, once per frame
+FRAME_MS = 16
+IDLE_POLL_MS = 50
+MAX_UPDATES_PER_FRAME = 500
+# Only the newest messages are fetched on startup, older pages on scroll-up
+INITIAL_HISTORY = 100
+HISTORY_PAGE = 100
+# Queued in self.updates when the client drops the history received so far
+RESET = object()
+
 class ChatGUI:
-    def __init__(self, username):
+    def __init__(self, username, max_messages=MAX_RETAINED_MESSAGES):
         self.emoji_list = ["😊", "😂", "😍", "👍", "🔥", "😭", "😎"]
         
         self.emoji_index = 0
+        self.is_closing = False
+        self.updates = queue.Queue()  # Filled by the receive thread, drained on the Tk loop
+        self.older_pages = queue.Queue()  # Filled by load_older, drained on the Tk loop
+        self.loading_older = False
+        self.history_generation = 0  # Bumped on reset, pages fetched before it are dropped
 
         self.username = username
-        self.chat_client = ChatClient(username=self.username, on_message_callback=self.display_message)
 
         try:
-            self.chat_client = ChatClient(username=self.username, on_message_callback=self.display_message)
+            self.chat_client = ChatClient(
+                username=self.username,
+                on_message_callback=self.display_message,
+                on_reset_callback=lambda: self.updates.put(RESET),
+                max_backlog=INITIAL_HISTORY,
+                cache_path=DEFAULT_CACHE_PATH
+            )
             
             if not self.chat_client.check_username_available():
                 # Handle username already taken
@@ -38,8 +62,16 @@ class ChatGUI:
         self.header = ctk.CTkLabel(self.window, text="Welcome to the CS4459 Chatroom!", font=('Helvetica', 16, 'bold'))
         self.header.pack(pady=(10, 0))
 
-        # chat display area (not readonly, but we avoid user typing into it)
-        self.chat_frame = ctk.CTkScrollableFrame(self.window, width=500, height=400, fg_color="transparent")
+        # chat display area, only the rows on screen have widgets
+        self.chat_frame = VirtualChatView(
+            self.window,
+            username,
+            max_messages=max_messages,
+            on_scroll_top=self.load_older,
+            width=500,
+            height=400,
+            fg_color="transparent"
+        )
         self.chat_frame.pack(padx=20, pady=20, fill="both", expand=True)
 
         # --- Message input row ---
@@ -78,17 +110,29 @@ class ChatGUI:
         self.window.protocol("WM_DELETE_WINDOW", self.on_close)
         # start receiving messages only after full GUI is built
         threading.Thread(target=self.chat_client.receive_messages, daemon=True).start()
+        self.window.after(FRAME_MS, self.apply_updates)
 
         self.window.after(100, self.scroll_to_bottom)
 
     #when messages are sent, scroll to bottom - not sure why this wasn't happening before
     def scroll_to_bottom(self):
         try:
-            self.window.after_idle(lambda: self.chat_frame._parent_canvas.yview_moveto(1.0))
+            self.window.after_idle(self.chat_frame.scroll_to_bottom)
         except Exception as e:
             if not self.is_closing:
                 print(f"Error scrolling: {e}")
 
+    def load_older(self):
+        # Called by the view when scrolled to the top, fetches off the Tk loop
+        if self.loading_older or self.chat_client.history_complete:
+            return
+        self.loading_older = True
+        generation = self.history_generation
+        threading.Thread(
+            target=lambda: self.older_pages.put((generation, self.chat_client.load_older(HISTORY_PAGE))),
+            daemon=True
+        ).start()
+
     def on_enter_pressed(self, event=None):
         message = self.input_field.get("0.0","end").strip()
         if message:
@@ -99,27 +143,41 @@ class ChatGUI:
         self.input_field.insert("end", emoji)
     
     def display_message(self, sender, message):
-        #self.chat_display.configure(state='normal')
-        is_you = sender == self.username
-        display_name = "You" if is_you else sender
-    
-        bubble = ctk.CTkFrame(
-            self.chat_frame,
-            fg_color="#3b82f6" if is_you else "#4b5563",  # blue / gray
-            corner_radius=15
-        )
-        bubble.pack(pady=5, padx=10, anchor="w" if is_you else "e")
-
-        msg_label = ctk.CTkLabel(
-            bubble,
-            text=f"{display_name}: {message}",
-            wraplength=160,
-            font=("Helvetica", 13),
-            justify="left",
-            text_color="white"
-        )
-        msg_label.pack(padx=10, pady=6)
-        self.scroll_to_bottom()       
+        # Called on the receive thread, Tk widgets may only be touched by apply_updates
+        self.updates.put((sender, message))
+
+    def apply_updates(self):
+        if self.is_closing:
+            return
+        batch = []
+        while len(batch) < MAX_UPDATES_PER_FRAME:
+            try:
+                item = self.updates.get_nowait()
+            except queue.Empty:
+                break
+            if item is RESET:
+                # The server's history was reset, everything shown so far is stale
+                batch = []
+                self.chat_frame.clear()
+                self.history_generation += 1
+                self.loading_older = False
+                continue
+            batch.append(item)
+        if batch:
+            # One layout pass for the whole batch, the view keeps following
+            # new messages unless the user scrolled up
+            self.chat_frame.extend(batch)
+        try:
+            generation, page = self.older_pages.get_nowait()
+            # A page fetched before a reset belongs to the old history
+            if generation == self.history_generation:
+                if not self.chat_frame.prepend(page):
+                    # The view is full, stop paging further back
+                    self.chat_client.history_complete = True
+                self.loading_older = False
+        except queue.Empty:
+            pass
+        self.window.after(FRAME_MS if batch else IDLE_POLL_MS, self.apply_updates)
 
     def on_close(self):
         # Set closing flag immediately to prevent new operations
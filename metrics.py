@@ -0,0 +1,323 @@
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import grpc
+
+from storage import MessageStore
+
+log = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Histogram:
+    """Counts of observed values per bucket, plus their sum"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, fraction):
+        # Upper bound of the bucket holding the quantile, None if nothing was observed
+        with self.lock:
+            target = fraction * self.count
+            seen = 0
+            for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+                seen += count
+                if count and seen >= target:
+                    return bound
+        return None
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metrics:
+    """Registry of named counters, histograms and gauges.
+
+    Counters and histograms are created on first use, one per distinct
+    set of labels. Gauges are functions read when the metrics are
+    rendered, so tracking e.g. the number of open streams costs nothing
+    on the hot path.
+    """
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> Counter
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.gauges = {}      # name -> function
+        self.lock = threading.Lock()
+
+    def _get(self, table, factory, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = table.get(key)
+        if metric is None:
+            with self.lock:
+                metric = table.setdefault(key, factory())
+        return metric
+
+    def counter(self, name, **labels):
+        return self._get(self.counters, Counter, name, labels)
+
+    def histogram(self, name, **labels):
+        return self._get(self.histograms, Histogram, name, labels)
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        lines = []
+        for (name, labels), counter in sorted(self.counters.items()):
+            lines.append(f"{name}{_labels(labels)} {counter.value}")
+        for name, function in sorted(self.gauges.items()):
+            lines.append(f"{name} {function()}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            with histogram.lock:
+                counts = list(histogram.counts)
+                total, count = histogram.sum, histogram.count
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """One line per metric, for the periodic dump to the log"""
+        lines = [f"{name}{_labels(labels)}={counter.value}" for (name, labels), counter in sorted(self.counters.items())]
+        lines += [f"{name}={function()}" for name, function in sorted(self.gauges.items())]
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if histogram.count:
+                lines.append(
+                    f"{name}{_labels(labels)} count={histogram.count} "
+                    f"mean={histogram.sum / histogram.count * 1000:.2f}ms "
+                    f"p50<={histogram.quantile(0.5) * 1000:g}ms p99<={histogram.quantile(0.99) * 1000:g}ms"
+                )
+        return lines
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def serve_metrics(metrics, port):
+    """Serve metrics.render() at http://localhost:<port>/metrics from a background thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes are not worth a log line each
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def dump_metrics(metrics, interval, stopping):
+    """Log a summary of the metrics every interval seconds until stopping is set"""
+
+    def run():
+        while not stopping.wait(interval):
+            for line in metrics.summary():
+                log.info("%s", line)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+class TimedStore(MessageStore):
+    """MessageStore wrapper recording the duration of every call"""
+
+    def __init__(self, store, metrics):
+        self.store = store
+        self.metrics = metrics
+
+    def _timed(self, operation):
+        return self.metrics.histogram('store_seconds', engine=type(self.store).__name__, op=operation).time()
+
+    def last_seq(self):
+        with self._timed('last_seq'):
+            return self.store.last_seq()
+
+    def insert_many(self, documents):
+        with self._timed('insert_many'):
+            self.store.insert_many(documents)
+
+    def find_since(self, room, seq, until=None, limit=None):
+        with self._timed('find_since'):
+            return self.store.find_since(room, seq, until, limit)
+
+    def find_tail(self, room, seq, limit, until=None):
+        with self._timed('find_tail'):
+            return self.store.find_tail(room, seq, limit, until)
+
+    def room_names(self):
+        with self._timed('rooms'):
+            return self.store.room_names()
+
+    def count(self, room):
+        with self._timed('count'):
+            return self.store.count(room)
+
+    def delete_through(self, room, seq):
+        with self._timed('delete_through'):
+            self.store.delete_through(room, seq)
+
+    def close(self):
+        self.store.close()
+
+
+def _method_name(handler_call_details):
+    return handler_call_details.method.rsplit('/', 1)[-1]
+
+
+def wrap_handler(handler, unary, stream):
+    # Rebuild a method handler around new behaviours, keeping its serializers
+    if handler.unary_unary:
+        return grpc.unary_unary_rpc_method_handler(
+            unary(handler.unary_unary), handler.request_deserializer, handler.response_serializer)
+    if handler.stream_unary:
+        return grpc.stream_unary_rpc_method_handler(
+            unary(handler.stream_unary), handler.request_deserializer, handler.response_serializer)
+    if handler.unary_stream:
+        return grpc.unary_stream_rpc_method_handler(
+            stream(handler.unary_stream), handler.request_deserializer, handler.response_serializer)
+    return grpc.stream_stream_rpc_method_handler(
+        stream(handler.stream_stream), handler.request_deserializer, handler.response_serializer)
+
+
+class MetricsInterceptor(grpc.ServerInterceptor):
+    """Records call counts, errors and latency of unary RPCs, and the number
+    of open streams and messages sent on streaming RPCs"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = _method_name(handler_call_details)
+        metrics = self.metrics
+
+        def unary(behavior):
+            def wrapper(request, context):
+                metrics.counter('rpc_total', method=method).inc()
+                try:
+                    with metrics.histogram('rpc_seconds', method=method).time():
+                        return behavior(request, context)
+                except Exception:
+                    metrics.counter('rpc_errors_total', method=method).inc()
+                    raise
+            return wrapper
+
+        def stream(behavior):
+            def wrapper(request, context):
+                metrics.counter('rpc_total', method=method).inc()
+                active = metrics.counter('streams_active', method=method)
+                sent = metrics.counter('stream_messages_total', method=method)
+                active.inc()
+                try:
+                    for response in behavior(request, context):
+                        sent.inc()
+                        yield response
+                except Exception:
+                    metrics.counter('rpc_errors_total', method=method).inc()
+                    raise
+                finally:
+                    active.inc(-1)
+            return wrapper
+
+        return wrap_handler(handler, unary, stream)
+
+
+class AioMetricsInterceptor(grpc.aio.ServerInterceptor):
+    """MetricsInterceptor for the grpc.aio server"""
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler is None:
+            return None
+        method = _method_name(handler_call_details)
+        metrics = self.metrics
+
+        def unary(behavior):
+            async def wrapper(request, context):
+                metrics.counter('rpc_total', method=method).inc()
+                try:
+                    with metrics.histogram('rpc_seconds', method=method).time():
+                        return await behavior(request, context)
+                except Exception:
+                    metrics.counter('rpc_errors_total', method=method).inc()
+                    raise
+            return wrapper
+
+        def stream(behavior):
+            async def wrapper(request, context):
+                metrics.counter('rpc_total', method=method).inc()
+                active = metrics.counter('streams_active', method=method)
+                sent = metrics.counter('stream_messages_total', method=method)
+                active.inc()
+                try:
+                    async for response in behavior(request, context):
+                        sent.inc()
+                        yield response
+                except Exception:
+                    metrics.counter('rpc_errors_total', method=method).inc()
+                    raise
+                finally:
+                    active.inc(-1)
+            return wrapper
+
+        return wrap_handler(handler, unary, stream)
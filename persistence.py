@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Durability modes for the write-behind stage
+ACK_AFTER_ENQUEUE = 'enqueue'  # Acknowledge as soon as the message is queued
+ACK_AFTER_FLUSH = 'flush'      # Acknowledge once the batch holding it is in the database
+
+
+class PendingWrite:
+    """Handle for one queued document, completed when its batch is flushed"""
+
+    def __init__(self, document, on_written=None):
+        self.document = document
+        self.on_written = on_written  # Called on the writer thread once the document is stored
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self, timeout=None):
+        # True if the document was written, False on error or timeout
+        return self.done.wait(timeout) and self.error is None
+
+
+class WriteBehindWriter:
+    """Queues message documents and writes them to a MessageStore in the background.
+
+    A batch is flushed once it reaches batch_size documents or once the
+    oldest queued document has waited flush_interval seconds.
+    """
+
+    def __init__(self, store, batch_size=100, flush_interval=0.05, max_retries=3):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.queue = queue.Queue()
+        self.stopping = threading.Event()
+        # Seqs of documents queued or being written, for readers that must not miss them
+        self.unwritten = set()
+        self.written = threading.Condition()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, document, on_written=None):
+        pending = PendingWrite(document, on_written)
+        with self.written:
+            self.unwritten.add(document['seq'])
+        self.queue.put((document, pending))
+        return pending
+
+    def pending_count(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            # Keep collecting until the batch is full or the oldest entry is due
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(batch)
+
+    def _flush(self, batch):
+        documents = [document for document, _ in batch]
+        error = None
+
+        for attempt in range(self.max_retries):
+            try:
+                self.store.insert_many(documents)
+                error = None
+                break
+            except Exception as e:
+                # Stores skip documents a failed attempt already wrote, so the whole batch is retried
+                error = e
+                time.sleep(0.1 * (attempt + 1))
+
+        if error is not None:
+            log.error("Failed to save %d messages: %s", len(documents), error)
+
+        for _, pending in batch:
+            if error is None and pending.on_written is not None:
+                try:
+                    pending.on_written(pending.document)
+                except Exception:
+                    log.exception("Callback for a written message failed")
+            pending.error = error
+            pending.done.set()
+        with self.written:
+            self.unwritten.difference_update(document['seq'] for document, _ in batch)
+            self.written.notify_all()
+
+    def wait_written(self, seq=None, timeout=None):
+        """Wait until every queued document up to seq (or every one) has been written"""
+        with self.written:
+            return self.written.wait_for(
+                lambda: not self.unwritten or (seq is not None and min(self.unwritten) > seq),
+                timeout,
+            )
+
+    def drain(self, timeout=None):
+        """Stop accepting new batches and wait for everything queued to be written"""
+        self.stopping.set()
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
@@ -0,0 +1,144 @@
+import heapq
+import threading
+import time
+import zlib
+
+
+class PresenceEntry:
+    __slots__ = ('last_heartbeat',)
+
+    def __init__(self, last_heartbeat):
+        self.last_heartbeat = last_heartbeat
+
+
+class PresenceRegistry:
+    """Connected users, striped across independently locked shards.
+
+    Reserving and removing a username only lock the username's shard.
+    Refreshing a heartbeat takes no lock at all: the entry lookup and the
+    timestamp store are each atomic, and a touch racing with a removal at
+    worst refreshes an entry that is already gone.
+    """
+
+    def __init__(self, shards=16):
+        self.shards = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+
+    def _shard(self, username):
+        return zlib.crc32(username.encode('utf-8')) % len(self.shards)
+
+    def reserve(self, username, now=None):
+        """Atomically claim a username, False if it is already connected"""
+        index = self._shard(username)
+        with self.locks[index]:
+            shard = self.shards[index]
+            if username in shard:
+                return False
+            shard[username] = PresenceEntry(time.time() if now is None else now)
+            return True
+
+    def touch(self, username, now=None):
+        """Refresh the user's heartbeat, False if they aren't connected"""
+        entry = self.shards[self._shard(username)].get(username)
+        if entry is None:
+            return False
+        entry.last_heartbeat = time.time() if now is None else now
+        return True
+
+    def remove(self, username):
+        index = self._shard(username)
+        with self.locks[index]:
+            return self.shards[index].pop(username, None) is not None
+
+    def expire(self, username, timeout, now=None):
+        """Remove the user if their heartbeat is older than timeout.
+
+        Returns (removed, deadline), deadline being the user's next deadline
+        if they are still connected, else None.
+        """
+        now = time.time() if now is None else now
+        index = self._shard(username)
+        with self.locks[index]:
+            entry = self.shards[index].get(username)
+            if entry is None:
+                return False, None
+            deadline = entry.last_heartbeat + timeout
+            if deadline > now:
+                return False, deadline
+            del self.shards[index][username]
+            return True, None
+
+    def __contains__(self, username):
+        return username in self.shards[self._shard(username)]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def usernames(self):
+        return [username for shard in self.shards for username in list(shard)]
+
+
+class ExpiryScheduler:
+    """Min-heap of presence deadlines, serviced by one sleeping thread.
+
+    Heartbeats don't touch the heap, they only refresh the user's timestamp.
+    When a deadline comes up, `check(key)` is called and decides whether the
+    user has expired (return None) or is still alive (return the new deadline
+    to be rescheduled). Each expiry or reschedule costs O(log n) and the
+    thread sleeps until the next deadline, so an idle server does no work.
+    A key has at most one live entry: scheduling it again before its
+    deadline comes up is a no-op, as the check reschedules it anyway.
+    """
+
+    def __init__(self, check):
+        self.check = check
+        self.heap = []
+        self.scheduled = {}  # key -> deadline of its live heap entry
+        self.condition = threading.Condition()
+        self.stopping = False
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, key, deadline):
+        with self.condition:
+            current = self.scheduled.get(key)
+            if current is not None and current <= deadline:
+                return
+            # An earlier deadline replaces the entry, the old one is skipped when it comes up
+            self.scheduled[key] = deadline
+            heapq.heappush(self.heap, (deadline, key))
+            # Only wake the thread if this is now the earliest deadline
+            if self.heap[0][1] == key:
+                self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.scheduled)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if self.stopping:
+                    return
+                deadline, key = heapq.heappop(self.heap)
+                if self.scheduled.get(key) != deadline:
+                    continue  # Replaced by an earlier entry
+                del self.scheduled[key]
+
+            deadline = self.check(key)
+            if deadline is not None:
+                self.schedule(key, deadline)
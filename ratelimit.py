@@ -0,0 +1,169 @@
+import threading
+import time
+
+import grpc
+
+from metrics import wrap_handler
+from transport import RETRY_AFTER_KEY
+
+# Per-user buckets are swept for idle ones whenever this many have been added
+SWEEP_EVERY = 1024
+
+
+class Rejected:
+    """Why a message was not admitted, and how long the sender should wait"""
+
+    def __init__(self, reason, message, retry_after):
+        self.reason = reason  # Short label for metrics
+        self.message = message
+        self.retry_after = retry_after  # seconds
+
+    @property
+    def retry_after_ms(self):
+        return max(1, int(self.retry_after * 1000))
+
+    @property
+    def details(self):
+        return f"{self.message}, retry in {self.retry_after_ms} ms"
+
+    def trailing_metadata(self):
+        return ((RETRY_AFTER_KEY, str(self.retry_after_ms)),)
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+
+
+class RateLimiter:
+    """Per-user token buckets: rate messages per second, bursts of up to burst.
+
+    A bucket is created full on a user's first message. Buckets that have
+    refilled are indistinguishable from new ones, so they are dropped from
+    time to time to keep memory bounded.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # username -> TokenBucket
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def take(self, username, now=None):
+        """Use one token, returns 0 if there was one, else seconds until there will be"""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            bucket = self.buckets.get(username)
+            if bucket is None:
+                bucket = self.buckets[username] = TokenBucket(self.burst, now)
+                self.added += 1
+                if self.added >= SWEEP_EVERY:
+                    self._sweep(now)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return 0
+            return (1 - bucket.tokens) / self.rate
+
+    def _sweep(self, now):
+        # Called with the lock held
+        full = self.burst / self.rate
+        self.buckets = {name: bucket for name, bucket in self.buckets.items() if now - bucket.updated < full}
+        self.added = 0
+
+
+class AdmissionControl:
+    """Server-wide load shedding for new messages.
+
+    A message is refused while the worker pool is nearly full, so there are
+    threads left for heartbeats and new streams, or while the write-behind
+    queue is so long that acking more would only grow the backlog. Open
+    streams park a worker each for as long as they last, so occupancy is
+    the share of the remaining workers busy with short unary calls. Calls
+    are counted by the AdmissionInterceptor; without a fixed pool
+    (workers=None, as on the asyncio server) only the write queue is checked.
+    """
+
+    def __init__(self, write_queue_depth, workers=None, max_occupancy=0.9, max_write_queue=10000,
+                 retry_after=0.5):
+        self.write_queue_depth = write_queue_depth
+        self.workers = workers
+        self.max_occupancy = max_occupancy
+        self.max_write_queue = max_write_queue
+        self.retry_after = retry_after
+        self.active = 0  # Unary calls being handled
+        self.streams = 0  # Open streaming calls, each holding a worker
+        self.lock = threading.Lock()
+
+    def enter(self, stream=False):
+        with self.lock:
+            if stream:
+                self.streams += 1
+            else:
+                self.active += 1
+
+    def exit(self, stream=False):
+        with self.lock:
+            if stream:
+                self.streams -= 1
+            else:
+                self.active -= 1
+
+    def occupancy(self, others=None):
+        # Share of the workers not parked on streams that are handling unary calls
+        if not self.workers:
+            return 0.0
+        active = self.active if others is None else others
+        free = self.workers - self.streams
+        return active / free if free > 0 else 1.0
+
+    def check(self, counted=False):
+        """None if a new message may be accepted, else a Rejected.
+
+        counted is True when the caller is itself one of the unary calls
+        counted, it doesn't count against its own admission.
+        """
+        others = self.active - 1 if counted else self.active
+        if self.workers and self.occupancy(others) >= self.max_occupancy:
+            return Rejected('occupancy', "Server busy", self.retry_after)
+        if self.max_write_queue and self.write_queue_depth() >= self.max_write_queue:
+            return Rejected('write_queue', "Server busy saving messages", self.retry_after)
+        return None
+
+
+class AdmissionInterceptor(grpc.ServerInterceptor):
+    """Counts the unary calls and open streams occupying the thread pool server's workers"""
+
+    def __init__(self, admission):
+        self.admission = admission
+
+    def intercept_service(self, continuation, handler_call_details):
+        handler = continuation(handler_call_details)
+        if handler is None:
+            return None
+        admission = self.admission
+
+        def unary(behavior):
+            def wrapper(request, context):
+                admission.enter()
+                try:
+                    return behavior(request, context)
+                finally:
+                    admission.exit()
+            return wrapper
+
+        def stream(behavior):
+            def wrapper(request, context):
+                admission.enter(stream=True)
+                try:
+                    yield from behavior(request, context)
+                finally:
+                    admission.exit(stream=True)
+            return wrapper
+
+        return wrap_handler(handler, unary, stream)
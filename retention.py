@@ -0,0 +1,261 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import quote, unquote
+
+from storage import MessageStore
+
+log = logging.getLogger(__name__)
+
+# Largest number of messages in one archive file
+ARCHIVE_FILE_MESSAGES = 10000
+# Decoded archive files kept in memory for repeated history reads
+ARCHIVE_FILES_CACHED = 8
+# Messages younger than this are never archived, so one still waiting in
+# a write queue can't end up below the archived range of its room
+MIN_ARCHIVE_AGE = 60
+
+
+class RetentionPolicy:
+    """How many messages, and how old, a room keeps in the hot store.
+
+    Either limit may be None. Messages without a timestamp predate it and
+    count as old.
+    """
+
+    def __init__(self, max_age_seconds=None, max_count=None):
+        self.max_age_seconds = max_age_seconds
+        self.max_count = max_count
+
+    @property
+    def enabled(self):
+        return self.max_age_seconds is not None or self.max_count is not None
+
+
+class Archive:
+    """Cold storage: gzipped JSON lines files, one directory per room.
+
+    Each file holds a run of a room's messages and is named after the first
+    and last seq in it, so the index is rebuilt from a directory listing.
+    Files are only ever added, and always above the room's archived range.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}  # room -> [(first seq, last seq, path)] sorted by seq
+        self.decoded = OrderedDict()  # path -> documents, least recently used first
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            room_directory = os.path.join(directory, name)
+            if not os.path.isdir(room_directory):
+                continue
+            files = []
+            for file_name in os.listdir(room_directory):
+                if not file_name.endswith('.jsonl.gz'):
+                    continue  # A temporary file left by a crash
+                first, last = file_name[:-len('.jsonl.gz')].split('-')
+                files.append((int(first), int(last), os.path.join(room_directory, file_name)))
+            self.files[unquote(name)] = sorted(files)
+
+    def archived_through(self, room):
+        # Every message of the room up to this seq is archived
+        with self.lock:
+            files = self.files.get(room)
+            return files[-1][1] if files else 0
+
+    def last_seq(self):
+        with self.lock:
+            return max((files[-1][1] for files in self.files.values() if files), default=0)
+
+    def write(self, room, documents):
+        # Archive documents, oldest first, all newer than archived_through(room)
+        room_directory = os.path.join(self.directory, quote(room, safe=''))
+        os.makedirs(room_directory, exist_ok=True)
+        first, last = documents[0]['seq'], documents[-1]['seq']
+        path = os.path.join(room_directory, f"{first:020d}-{last:020d}.jsonl.gz")
+        temporary = path + '.tmp'
+        with gzip.open(temporary, 'wt', encoding='utf-8') as f:
+            for document in documents:
+                f.write(json.dumps([document['seq'], document['user'], document['message'], document.get('ts')]) + "\n")
+        os.replace(temporary, path)
+        with self.lock:
+            self.files.setdefault(room, []).append((first, last, path))
+
+    def _read(self, room, path):
+        with self.lock:
+            documents = self.decoded.get(path)
+            if documents is not None:
+                self.decoded.move_to_end(path)
+                return documents
+        documents = []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                seq, user, message, ts = json.loads(line)
+                documents.append({'seq': seq, 'room': room, 'user': user, 'message': message, 'ts': ts})
+        with self.lock:
+            self.decoded[path] = documents
+            if len(self.decoded) > ARCHIVE_FILES_CACHED:
+                self.decoded.popitem(last=False)
+        return documents
+
+    def _overlapping(self, room, seq, until):
+        with self.lock:
+            files = list(self.files.get(room, ()))
+        return [path for first, last, path in files if last > seq and (until is None or first <= until)]
+
+    def find_since(self, room, seq, until=None, limit=None):
+        found = []
+        for path in self._overlapping(room, seq, until):
+            for document in self._read(room, path):
+                if document['seq'] > seq and (until is None or document['seq'] <= until):
+                    found.append(document)
+                    if limit is not None and len(found) == limit:
+                        return found
+        return found
+
+    def find_tail(self, room, seq, limit, until=None):
+        found = []
+        for path in reversed(self._overlapping(room, seq, until)):
+            for document in reversed(self._read(room, path)):
+                if document['seq'] > seq and (until is None or document['seq'] <= until):
+                    found.append(document)
+                    if len(found) == limit:
+                        return found[::-1]
+        return found[::-1]
+
+
+class ArchivedStore(MessageStore):
+    """A hot MessageStore with an Archive underneath.
+
+    Writes go to the hot store. Reads take a room's messages up to
+    archived_through(room) from the archive and the rest from the hot store,
+    so history stays readable after compaction.
+    """
+
+    def __init__(self, hot, archive):
+        self.hot = hot
+        self.archive = archive
+
+    def last_seq(self):
+        # The hot store may have lost its newest messages to compaction
+        return max(self.hot.last_seq(), self.archive.last_seq())
+
+    def insert_many(self, documents):
+        self.hot.insert_many(documents)
+
+    def find_since(self, room, seq, until=None, limit=None):
+        while True:
+            archived = self.archive.archived_through(room)
+            found = []
+            if seq < archived:
+                found = self.archive.find_since(room, seq, _lower(until, archived), limit)
+            if limit is None or len(found) < limit:
+                found += self.hot.find_since(room, max(seq, archived), until,
+                                             None if limit is None else limit - len(found))
+            # A compaction in between may have moved part of the range out of the hot store
+            if self.archive.archived_through(room) == archived:
+                return found
+
+    def find_tail(self, room, seq, limit, until=None):
+        while True:
+            archived = self.archive.archived_through(room)
+            found = self.hot.find_tail(room, max(seq, archived), limit, until)
+            if len(found) < limit and seq < archived:
+                found = self.archive.find_tail(room, seq, limit - len(found), _lower(until, archived)) + found
+            if self.archive.archived_through(room) == archived:
+                return found
+
+    def room_names(self):
+        return self.hot.room_names()
+
+    def count(self, room):
+        return self.hot.count(room)
+
+    def delete_through(self, room, seq):
+        self.hot.delete_through(room, seq)
+
+    def close(self):
+        self.hot.close()
+
+
+def _lower(until, seq):
+    return seq if until is None else min(until, seq)
+
+
+class Compactor:
+    """Moves messages outside the retention policy from the hot store to the archive.
+
+    Runs a compaction every interval seconds on a background thread. A room
+    is archived oldest first, one file at a time, and each file is deleted
+    from the hot store only after it is written, so a crash in between
+    leaves messages in both places; the next run deletes them.
+    """
+
+    def __init__(self, hot, archive, policy, interval=300, metrics=None):
+        self.hot = hot
+        self.archive = archive
+        self.policy = policy
+        self.interval = interval
+        self.archived = metrics.counter('archived_messages_total') if metrics else None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.compact()
+            except Exception:
+                log.exception("Compaction failed")
+            if self.stopping.wait(self.interval):
+                return
+
+    def compact(self):
+        started = time.monotonic()
+        total = sum(self._compact_room(room) for room in self.hot.room_names())
+        if total:
+            log.info("Archived %d messages in %.2fs", total, time.monotonic() - started)
+        return total
+
+    def _compact_room(self, room):
+        archived = self.archive.archived_through(room)
+        if archived:
+            self.hot.delete_through(room, archived)  # Left over from an interrupted run
+
+        excess = self.hot.count(room) - self.policy.max_count if self.policy.max_count is not None else 0
+        now = time.time()
+        old = now - self.policy.max_age_seconds if self.policy.max_age_seconds is not None else None
+        total = 0
+        while not self.stopping.is_set():
+            documents = self.hot.find_since(room, archived, limit=ARCHIVE_FILE_MESSAGES)
+            count = 0
+            for document in documents:
+                ts = document.get('ts') or 0
+                if ts > now - MIN_ARCHIVE_AGE:
+                    break
+                if count >= excess and (old is None or ts >= old):
+                    break
+                count += 1
+            if not count:
+                break
+
+            self.archive.write(room, documents[:count])
+            archived = documents[count - 1]['seq']
+            self.hot.delete_through(room, archived)
+            excess -= count
+            total += count
+            if self.archived:
+                self.archived.inc(count)
+            if count < len(documents):
+                break
+        return total
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
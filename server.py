@@ -1,158 +1,825 @@
 import grpc
 import chatservice_pb2
 import chatservice_pb2_grpc
+from broker import MessageBroker, Gap, RESYNC, SLOW_CONSUMER_POLICIES
+from bus import LoopbackBus, MongoChangeStreamBus
+from cache import HistoryCache
+from metrics import Metrics, MetricsInterceptor, TimedStore, dump_metrics, serve_metrics
+from presence import ExpiryScheduler, PresenceRegistry
+from ratelimit import AdmissionControl, AdmissionInterceptor, RateLimiter, Rejected
+from retention import Archive, ArchivedStore, Compactor, RetentionPolicy
+from storage import LOG, MEMORY, MONGO, STORES, LogStore, MemoryStore, MongoStore
+from transport import COMPRESSION_ALGORITHMS, TransportConfig
+from persistence import WriteBehindWriter, ACK_AFTER_ENQUEUE, ACK_AFTER_FLUSH
 
+import argparse
+import asyncio
+import logging
+import logging.handlers
+import os
+import queue
+from collections import OrderedDict
 from concurrent import futures
 from pymongo import MongoClient
 import time
 import threading
+import uuid
+
+log = logging.getLogger(__name__)
+
+# Number of messages read from the database per history round trip
+HISTORY_PAGE_SIZE = 500
+# Seconds without a heartbeat or message before a user is dropped
+HEARTBEAT_TIMEOUT = 15
+# Seconds a history read waits for queued messages to reach the database
+HISTORY_WRITE_WAIT = 5
+# Room used by requests that don't name one
+DEFAULT_ROOM = 'general'
+# Live BatchStream batches: how long to wait for more messages, and the largest batch
+BATCH_WINDOW_MS = 20
+MAX_BATCH = 100
+# Status details sent to a stream closed by the disconnect slow-consumer policy
+SLOW_CONSUMER_ERROR = "Stream fell too far behind, resume from the last received seq"
+# A stream resuming after a seq this node has not seen waits this many seconds
+# for it to arrive before telling the client its history is gone
+RESUME_AHEAD_WAIT = 2
+RESUME_AHEAD_ERROR = "since_seq is ahead of the server's history, drop cached messages and resume from 0"
+# Delivery times remembered for measuring how far behind streams are
+DELIVERY_TIMES_KEPT = 10000
 
 class ChatService(chatservice_pb2_grpc.ChatServiceServicer):
-    def __init__(self):
-        # initialize mongodb service, currently on local
-        self.mongo_client = MongoClient('localhost', 27017)
-        self.db = self.mongo_client.chat_db
-        self.connected_users = {}  # Dictionary to store user data
-        self.lock = threading.Lock()  # Add lock for thread safety
-
-        # Start the heartbeat checking thread
-        self.heartbeat_thread = threading.Thread(target=self._check_heartbeats, daemon=True)
-        self.heartbeat_thread.start()
-
-    def _check_heartbeats(self):
-        HEARTBEAT_TIMEOUT = 15  
-        
-        while True:
-            current_time = time.time()
-            users_to_remove = []
-            
-            with self.lock:
-                for username, user_data in self.connected_users.items():
-                    last_heartbeat = user_data.get('last_heartbeat', 0)
-                    if current_time - last_heartbeat > HEARTBEAT_TIMEOUT:
-                        users_to_remove.append(username)
-            
-            # Remove disconnected users
-            for username in users_to_remove:
-                with self.lock:
-                    if username in self.connected_users:
-                        del self.connected_users[username]
-                        print(f"Removed inactive user: {username}")
+    def __init__(self, cache_messages=1000, cache_bytes=1024 * 1024, cache_rooms=100,
+                 write_batch_size=100, write_flush_interval=0.05, durability=ACK_AFTER_ENQUEUE,
+                 stream_queue=1000, slow_consumer_policy=RESYNC,
+                 mongo_client=None, bus=None, node_id=None, transport=None, store=None, metrics=None,
+                 retention=None, archive=None, compaction_interval=300,
+                 rate_limit=0, rate_burst=0, workers=None, max_occupancy=0.9, max_write_queue=10000):
+        # Compression and connection settings, also used to build the grpc server
+        self.transport = transport or TransportConfig()
+        self.metrics = metrics or Metrics()
+
+        # Message storage, MongoDB on localhost unless another store is given
+        store = store or MongoStore((mongo_client or MongoClient('localhost', 27017)).chat_db, DEFAULT_ROOM)
+        hot_store = TimedStore(store, self.metrics)
+        self.store = hot_store
+
+        # Messages past the retention policy move to compressed archive files,
+        # which history reads fall back to
+        self.compactor = None
+        if archive is not None:
+            self.store = ArchivedStore(hot_store, archive)
+            if retention is not None and retention.enabled:
+                self.compactor = Compactor(hot_store, archive, retention, compaction_interval, self.metrics)
+        self.connected_users = PresenceRegistry()  # Sharded, no global lock on the message path
+
+        # Every stored message gets a monotonic sequence id, indexed for range reads.
+        # last_seq is the newest message delivered to this node
+        self.history_lock = threading.RLock()  # Keeps cache and stream order == seq order
+        self.last_seq = self.store.last_seq()
+
+        # Recent messages of the most active rooms are served from memory,
+        # only older ranges hit the database
+        self.cache_messages = cache_messages
+        self.cache_bytes = cache_bytes
+        self.cache_rooms = cache_rooms
+        self.history_caches = OrderedDict()  # room -> HistoryCache, least recently used first
+
+        # Messages are written to the database in batches off the request thread
+        self.durability = durability
+        self.writer = WriteBehindWriter(
+            self.store,
+            batch_size=write_batch_size,
+            flush_interval=write_flush_interval,
+        )
+
+        # Messages are refused with RESOURCE_EXHAUSTED when their sender is over
+        # rate_limit per second, or when the server as a whole is overloaded
+        self.rate_limiter = RateLimiter(rate_limit, rate_burst or rate_limit) if rate_limit else None
+        self.admission = AdmissionControl(
+            self.writer.pending_count,
+            workers=workers,
+            max_occupancy=max_occupancy,
+            max_write_queue=max_write_queue,
+        )
+
+        # Fan-out of new messages to open ChatStreams, replaces history polling
+        self.broker = MessageBroker(max_queue=stream_queue, policy=slow_consumer_policy)
+
+        # Sequence ids, message delivery and username reservations go through the bus,
+        # so several nodes can serve the same chat. Without one this node is alone
+        self.node_id = node_id or uuid.uuid4().hex
+        self.owns_bus = bus is None
+        self.bus = bus or LoopbackBus()
+        self.bus.attach(self.node_id, self._deliver, self.last_seq)
+
+        # Drops users whose heartbeat deadline has passed, sleeps in between
+        self.presence_expiry = ExpiryScheduler(self._check_presence)
+
+        # Time each message was handed to the broker, by seq, to measure fan-out lag
+        self.delivered_at = OrderedDict()
+        # Seqs delivered by the bus after later ones, streams send them out of order
+        self.late_seqs = OrderedDict()
+        self.fanout_lag = self.metrics.histogram('fanout_lag_seconds')
+        self.metrics.gauge('presence_users', lambda: len(self.connected_users))
+        self.metrics.gauge('stream_subscribers', self.broker.subscriber_count)
+        self.metrics.gauge('stream_queued_messages', lambda: self.broker.stats()['queued'])
+        self.metrics.gauge('stream_dropped_messages', lambda: self.broker.dropped)
+        self.metrics.gauge('write_queue_depth', self.writer.pending_count)
+        self.metrics.gauge('last_seq', lambda: self.last_seq)
+        self.metrics.gauge('worker_occupancy', self.admission.occupancy)
+        # Room history caches, to size --cache-messages/--cache-bytes/--cache-rooms
+        for stat in ('rooms', 'messages', 'bytes', 'hits', 'misses'):
+            self.metrics.gauge(f'history_cache_{stat}', lambda stat=stat: self.cache_stats()[stat])
+
+    def _check_presence(self, username):
+        # Called when a user's deadline is due, returns the next deadline if still alive
+        removed, deadline = self.connected_users.expire(username, HEARTBEAT_TIMEOUT)
+        if removed:
+            self.bus.release(self.node_id, username)
+            self.metrics.counter('presence_expired_total').inc()
+            log.info("Removed inactive user: %s", username)
+        return deadline
 
     def ChatStream(self, request_iterator, context):
-        lastindex = 0
+        # Legacy stream, always replays the whole history of the default room
+        return self._stream_messages(DEFAULT_ROOM, 0, 0, context)
+
+    def ResumeStream(self, request, context):
+        return self._stream_messages(request.room or DEFAULT_ROOM, request.since_seq, request.max_backlog, context)
+
+    def _stream_messages(self, room, since_seq, max_backlog, context):
+        # Subscribe before reading the history so no message falls in between,
+        # anything seen twice is skipped by its sequence id
+        if self.resume_ahead(since_seq):
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, RESUME_AHEAD_ERROR)
+        subscription = self.broker.subscribe(room)
+        context.add_callback(subscription.close)
+        self.transport.enable_compression(context)
+        last_seq = since_seq
+
+        try:
+            for page in self.backlog_pages(room, since_seq, max_backlog):
+                for message in page:
+                    last_seq = message.seq
+                    self.transport.before_send(context, message)
+                    yield message
+
+            # Block on new messages instead of polling the database
+            while context.is_active():
+                message = subscription.get(timeout=1.0)
+                if message is not None:
+                    for page in self.live_pages(room, [message], last_seq):
+                        for message in page:
+                            last_seq = max(last_seq, message.seq)
+                            self.transport.before_send(context, message)
+                            yield message
+                elif subscription.closed:
+                    break
+            if subscription.overflowed:
+                context.abort(grpc.StatusCode.ABORTED, SLOW_CONSUMER_ERROR)
+        finally:
+            subscription.close()
+
+    def BatchStream(self, request, context):
+        room = request.room or DEFAULT_ROOM
+        window = min(request.batch_window_ms or BATCH_WINDOW_MS, 1000) / 1000
+        max_batch = request.max_batch or MAX_BATCH
+        if self.resume_ahead(request.since_seq):
+            context.abort(grpc.StatusCode.OUT_OF_RANGE, RESUME_AHEAD_ERROR)
+
+        subscription = self.broker.subscribe(room)
+        context.add_callback(subscription.close)
+        self.transport.enable_compression(context)
+        last_seq = request.since_seq
+
+        try:
+            # Backlog replay always goes out in full history pages
+            for page in self.backlog_pages(room, request.since_seq, request.max_backlog):
+                last_seq = page[-1].seq
+                yield self.batch_response(context, page)
+
+            # Live messages are coalesced over a short window
+            while context.is_active():
+                batch = subscription.get_batch(max_batch, window, timeout=1.0)
+                for page in self.live_pages(room, batch, last_seq):
+                    last_seq = max(last_seq, page[-1].seq)
+                    yield self.batch_response(context, page)
+                if not batch and subscription.closed:
+                    break
+            if subscription.overflowed:
+                context.abort(grpc.StatusCode.ABORTED, SLOW_CONSUMER_ERROR)
+        finally:
+            subscription.close()
+
+    def resume_ahead(self, since_seq):
+        # True if since_seq is past every message here, e.g. a client cache from
+        # before the database was wiped. Live messages would all be skipped as
+        # already seen, so such a stream must start over. Delivery from other
+        # nodes gets a moment to catch up first
+        deadline = time.monotonic() + RESUME_AHEAD_WAIT
+        while since_seq > self.last_seq:
+            if time.monotonic() >= deadline:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def batch_response(self, context, messages):
+        batch = chatservice_pb2.MessageBatch(messages=messages)
+        self.transport.before_send(context, batch)
+        return batch
+
+    def GetHistory(self, request, context):
+        self.transport.enable_compression(context)
+        return self.batch_response(context, self.history_page(request))
+
+    def history_page(self, request):
+        room = request.room or DEFAULT_ROOM
+        limit = min(request.limit or HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+        if request.before_seq > 0:
+            return self.get_history_before(room, request.before_seq, limit)
+        return self.get_history_tail(room, 0, limit)
+
+    def live_pages(self, room, items, last_seq):
+        # Pages of new messages from a subscription's queue items. A Gap left by
+        # the resync policy is filled from history, paced by the consumer
+        page = []
+        now = time.monotonic()
+        for item in items:
+            if isinstance(item, Gap):
+                if page:
+                    yield page
+                    page = []
+                for history_page in self.backlog_pages(room, last_seq):
+                    last_seq = history_page[-1].seq
+                    yield history_page
+            elif item.seq > last_seq or item.seq in self.late_seqs:
+                last_seq = max(last_seq, item.seq)
+                page.append(item)
+                delivered = self.delivered_at.get(item.seq)
+                if delivered is not None:
+                    self.fanout_lag.observe(now - delivered)
+        if page:
+            # A late message goes out in seq order with the rest of its page
+            page.sort(key=lambda message: message.seq)
+            yield page
+
+    def backlog_pages(self, room, since_seq, max_backlog=0):
+        # Pages of a room's messages after since_seq, used to catch a stream up
+        last_seq = since_seq
+        if max_backlog > 0:
+            # Only the newest max_backlog missed messages, older ones are skipped
+            page = self.get_history_tail(room, last_seq, max_backlog)
+            if page:
+                last_seq = page[-1].seq
+                yield page
 
         while True:
-            while len(self.get_chat_history()) > lastindex:
-                message = self.get_chat_history()[lastindex]
-                lastindex += 1
-                yield message
-            time.sleep(0.1)
+            page = self.get_history_since(room, last_seq, HISTORY_PAGE_SIZE)
+            if page:
+                last_seq = page[-1].seq
+                yield page
+            if len(page) < HISTORY_PAGE_SIZE:
+                break
+
+    def connect_user(self, username):
+        # Reserve the username, False if someone already has it on any node
+        now = time.time()
+        if not self.connected_users.reserve(username, now):
+            return False
+        if not self.bus.reserve(self.node_id, username):
+            self.connected_users.remove(username)
+            return False
+        self.presence_expiry.schedule(username, now + HEARTBEAT_TIMEOUT)
+        log.info("User connected: %s", username)
+        return True
+
+    def touch_user(self, username):
+        # Refresh the heartbeat time, False if the user isn't connected
+        return self.connected_users.touch(username)
+
+    def disconnect_user(self, username):
+        if not self.connected_users.remove(username):
+            return False
+        self.bus.release(self.node_id, username)
+        log.info("User disconnected: %s", username)
+        return True
+
+    def _presence_response(self, status):
+        return chatservice_pb2.PresenceResponse(
+            status=status,
+            heartbeat_timeout_ms=int(HEARTBEAT_TIMEOUT * 1000),
+        )
+
+    def Connect(self, request, context):
+        if self.connect_user(request.username):
+            return self._presence_response(chatservice_pb2.PresenceResponse.OK)
+        return self._presence_response(chatservice_pb2.PresenceResponse.USERNAME_TAKEN)
+
+    def Heartbeat(self, request, context):
+        if self.touch_user(request.username):
+            return self._presence_response(chatservice_pb2.PresenceResponse.OK)
+        return self._presence_response(chatservice_pb2.PresenceResponse.NOT_CONNECTED)
+
+    def Disconnect(self, request, context):
+        if self.disconnect_user(request.username):
+            return self._presence_response(chatservice_pb2.PresenceResponse.OK)
+        return self._presence_response(chatservice_pb2.PresenceResponse.NOT_CONNECTED)
+
+    def KeepAlive(self, request_iterator, context):
+        # Every request on the stream is a heartbeat, the user leaves when it closes
+        username = None
+        try:
+            for request in request_iterator:
+                username = request.username
+                yield self.Heartbeat(request, context)
+        finally:
+            if username is not None:
+                self.disconnect_user(username)
+
+    def admit_message(self, request, context=None):
+        # None if a chat message may be sent now, else a Rejected saying how long to wait.
+        # Presence requests still sent through SendMessage are never refused
+        if context is not None and dict(context.invocation_metadata()).get('message-type', 'chat') != 'chat':
+            return None
+        # SendMessage passes its context, and is itself one of the calls being counted
+        rejected = self.admission.check(counted=context is not None)
+        if rejected is None and self.rate_limiter is not None:
+            retry_after = self.rate_limiter.take(request.username)
+            if retry_after:
+                rejected = Rejected('rate', "Rate limit exceeded", retry_after)
+        if rejected is not None:
+            self.metrics.counter('rejected_messages_total', reason=rejected.reason).inc()
+        return rejected
 
     def SendMessage(self, request, context):
+        rejected = self.admit_message(request, context)
+        if rejected is not None:
+            context.set_trailing_metadata(rejected.trailing_metadata())
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, rejected.details)
+        return self.handle_message(request, context)
+
+    def handle_message(self, request, context):
         metadata = dict(context.invocation_metadata())
         message_type = metadata.get('message-type', 'chat')
         
-        # Handle heartbeat message
+        # Handle heartbeat message (legacy clients, new ones use the Heartbeat RPC)
         if message_type == 'heartbeat':
-            with self.lock:
-                if request.username in self.connected_users:
-                    self.connected_users[request.username]['last_heartbeat'] = time.time()
-                    return chatservice_pb2.MessageResponse(
-                        username="System",
-                        message="Heartbeat acknowledged"
-                    )
-                else:
-                    # Username not found, might have been timed out
-                    return chatservice_pb2.MessageResponse(
-                        username="System",
-                        message="ERROR: Not connected"
-                    )
-        
+            if self.touch_user(request.username):
+                return chatservice_pb2.MessageResponse(
+                    username="System",
+                    message="Heartbeat acknowledged"
+                )
+            # Username not found, might have been timed out
+            return chatservice_pb2.MessageResponse(
+                username="System",
+                message="ERROR: Not connected"
+            )
+
         # Handle connection request
         if message_type == 'connect':
-            with self.lock:
-                if request.username in self.connected_users:
-                    # Username is taken, return error message
-                    return chatservice_pb2.MessageResponse(
-                        username="System",
-                        message=f"ERROR: Username '{request.username}' is already taken."
-                    )
-                else:
-                    # Register the username and return success
-                    self.connected_users[request.username] = {
-                        'last_heartbeat': time.time()
-                    }
-                    print(f"User connected: {request.username}")
-                    return chatservice_pb2.MessageResponse(
-                        username="System",
-                        message=f"SUCCESS: Connected as '{request.username}'."
-                    )
-       
+            if not self.connect_user(request.username):
+                # Username is taken, return error message
+                return chatservice_pb2.MessageResponse(
+                    username="System",
+                    message=f"ERROR: Username '{request.username}' is already taken."
+                )
+            return chatservice_pb2.MessageResponse(
+                username="System",
+                message=f"SUCCESS: Connected as '{request.username}'."
+            )
+
         # Handle disconnection request
         if message_type == 'disconnect':
-            with self.lock:
-                if request.username in self.connected_users:
-                    del self.connected_users[request.username]
-                    print(f"User disconnected: {request.username}")
-            
+            self.disconnect_user(request.username)
             return chatservice_pb2.MessageResponse(
                 username="System",
                 message=f"User '{request.username}' has disconnected."
             )
-       
-        # For normal chat messages, verify user is connected
-        with self.lock:
-            if request.username not in self.connected_users:
-                # If the user isn't connected, reject the message
-                return chatservice_pb2.MessageResponse(
-                    username="System",
-                    message="ERROR: Not connected"
-                )
-            
-            # Update the heartbeat time for the user
-            self.connected_users[request.username]['last_heartbeat'] = time.time()
-       
+
+        # For normal chat messages, verify user is connected and refresh their heartbeat
+        if not self.touch_user(request.username):
+            # If the user isn't connected, reject the message
+            return chatservice_pb2.MessageResponse(
+                username="System",
+                message="ERROR: Not connected"
+            )
+
         # Process the message
-        self.save_history(request)
-        print(f"{request.username}: {request.message}")
+        pending = self.save_history(request)
+        if pending is not None and self.durability == ACK_AFTER_FLUSH and not pending.wait(timeout=5):
+            return chatservice_pb2.MessageResponse(
+                username="System",
+                message="ERROR: Message could not be saved"
+            )
+        log.debug("%s: %s", request.username, request.message)
+
+        return chatservice_pb2.MessageResponse(
+            username=request.username,
+            message=request.message,
+            seq=pending.document['seq'] if pending is not None else 0,
+            room=request.room or DEFAULT_ROOM,
+        )
 
-        return chatservice_pb2.MessageResponse(username=request.username, message=request.message)
+    def SendStream(self, request_iterator, context):
+        # Requests are accepted as fast as they arrive, on a reader thread, while
+        # this generator acks them in order. With ack-after-flush many messages
+        # in flight share one database write instead of waiting one by one
+        accepted = queue.Queue()
+
+        def read_requests():
+            try:
+                for request in request_iterator:
+                    accepted.put((request, self.accept_message(request)))
+            except Exception:
+                pass  # The stream was cancelled or broke
+            finally:
+                accepted.put(None)
+
+        threading.Thread(target=read_requests, daemon=True).start()
+        while True:
+            item = accepted.get()
+            if item is None:
+                break
+            request, pending = item
+            yield self.send_ack(request, pending)
+
+    def accept_message(self, request):
+        # Save a chat message from a connected user, None if they aren't connected
+        # and a Rejected if it can't be taken now
+        if not self.touch_user(request.username):
+            return None
+        rejected = self.admit_message(request)
+        if rejected is not None:
+            return rejected
+        return self.save_history(request)
+
+    def send_ack(self, request, pending):
+        if isinstance(pending, Rejected):
+            return chatservice_pb2.SendAck(
+                request_id=request.request_id,
+                status=chatservice_pb2.SendAck.RESOURCE_EXHAUSTED,
+                retry_after_ms=pending.retry_after_ms,
+            )
+        if pending is None:
+            return chatservice_pb2.SendAck(
+                request_id=request.request_id,
+                status=chatservice_pb2.SendAck.NOT_CONNECTED,
+            )
+        if self.durability == ACK_AFTER_FLUSH and not pending.wait(timeout=5):
+            status = chatservice_pb2.SendAck.FAILED
+        else:
+            status = chatservice_pb2.SendAck.OK
+        return chatservice_pb2.SendAck(
+            request_id=request.request_id,
+            status=status,
+            seq=pending.document['seq'],
+        )
 
     def save_history(self, request):
         # Only save user messages, not system messages
         if request.username != "System":
+            room = request.room or DEFAULT_ROOM
             message_doc = {
+                'seq': self.bus.next_seq(),
+                'room': room,
                 'message': request.message,
                 'user': request.username,
+                'ts': time.time(),
             }
-            self.db.messages.insert_one(message_doc)
+            if self.durability == ACK_AFTER_FLUSH:
+                # Nobody sees the message before it is stored and can be acked
+                return self.writer.enqueue(message_doc, on_written=self.publish_message)
+            pending = self.writer.enqueue(message_doc)
+            self.publish_message(message_doc)
+            return pending
+        return None
 
-    def get_chat_history(self):
-        # Exclude system messages from chat history
-        chat_history = self.db.messages.find()
+    def publish_message(self, message_doc):
+        # Every node, this one included, gets the message back from the bus in seq order
+        self.bus.publish(self.node_id, chatservice_pb2.MessageResponse(
+            username=message_doc['user'],
+            message=message_doc['message'],
+            seq=message_doc['seq'],
+            room=message_doc['room'],
+        ))
 
-        message_list = [chatservice_pb2.MessageResponse(
-            username=message['user'],
-            message=message['message'],
-        ) for message in chat_history]
+    def _deliver(self, message):
+        # Called by the bus for each message, in seq order
+        with self.history_lock:
+            cache = self._room_cache(message.room)
+            if message.seq <= self.last_seq:
+                # The bus gave up waiting for it, e.g. its write was slow
+                cache.insert(message)
+                self.late_seqs[message.seq] = True
+                if len(self.late_seqs) > DELIVERY_TIMES_KEPT:
+                    self.late_seqs.popitem(last=False)
+            else:
+                self.last_seq = message.seq
+                cache.append(message)
+            self.delivered_at[message.seq] = time.monotonic()
+            if len(self.delivered_at) > DELIVERY_TIMES_KEPT:
+                self.delivered_at.popitem(last=False)
+            # Push the message to every open ChatStream of its room
+            self.broker.publish(message)
 
-        return message_list
+    def close(self, timeout=10):
+        self.presence_expiry.stop()
+        if self.compactor:
+            self.compactor.stop()
+        self.bus.detach(self.node_id)
+        if self.owns_bus:
+            self.bus.close()
+        # Write out everything still queued so nothing is lost on shutdown
+        if not self.writer.drain(timeout):
+            log.error("Timed out with %d messages unsaved", self.writer.pending_count())
+        self.store.close()
 
-def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    chat_service = ChatService()
-    chatservice_pb2_grpc.add_ChatServiceServicer_to_server(chat_service, server)
-    server.add_insecure_port('[::]:50051')
-    server.start()
-
-    print("Server started")
-    try:
+    def history_cache(self, room):
+        # The room's cache, warmed from the database the first time it is read.
+        # That happens outside history_lock, so deliveries never wait on it
+        cache = self._room_cache(room)
+        if not cache.warmed:
+            floor = cache.floor
+            cache.prepend(self._load_history_tail(room, 0, self.cache_messages, until=floor), floor)
+        return cache
+
+    def _room_cache(self, room):
+        with self.history_lock:
+            cache = self.history_caches.get(room)
+            if cache is not None:
+                self.history_caches.move_to_end(room)
+                return cache
+
+            # Holding history_lock, so no message of this room can be delivered in
+            # between. Anything after last_seq is still on its way to _deliver,
+            # which appends it, so the cache starts out complete above last_seq
+            cache = HistoryCache(max_messages=self.cache_messages, max_bytes=self.cache_bytes)
+            cache.reset([], self.last_seq)
+            self.history_caches[room] = cache
+            if len(self.history_caches) > self.cache_rooms:
+                self.history_caches.popitem(last=False)
+            return cache
+
+    def cache_stats(self):
+        with self.history_lock:
+            caches = list(self.history_caches.values())
+        stats = [cache.stats() for cache in caches]
+        return {
+            'rooms': len(stats),
+            'messages': sum(s['messages'] for s in stats),
+            'bytes': sum(s['bytes'] for s in stats),
+            'hits': sum(s['hits'] for s in stats),
+            'misses': sum(s['misses'] for s in stats),
+        }
+
+    def get_history_since(self, room, seq, limit=None):
+        cache = self.history_cache(room)
+        messages = []
         while True:
-            time.sleep(86400)
-    except KeyboardInterrupt:
-        print("\nClosing server")
-        server.stop(0)
+            remaining = limit - len(messages) if limit else None
+            cached = cache.get_since(seq, remaining)
+            if cached is not None:
+                return messages + cached
+            # Read up to the cache floor from the database, the rest may not be
+            # written yet and has to come from the cache on the next pass
+            floor = cache.floor
+            messages += self._load_history_since(room, seq, remaining, until=floor)
+            if limit and len(messages) >= limit:
+                return messages
+            seq = floor
+
+    def get_history_tail(self, room, seq, limit):
+        cache = self.history_cache(room)
+        while True:
+            cached = cache.get_tail(seq, limit)
+            if cached is not None:
+                return cached
+            # Everything still cached, topped up with older messages from the database
+            floor = cache.floor
+            newer = cache.get_since(floor)
+            if newer is None:
+                continue  # The floor moved meanwhile, try again
+            older = self._load_history_tail(room, seq, limit - len(newer), until=floor)
+            return older + newer
+
+    def get_history_before(self, room, seq, limit):
+        # A page of history older than seq, for clients scrolling back
+        cache = self.history_cache(room)
+        while True:
+            cached = cache.get_before(seq, limit)
+            if cached is not None:
+                return cached
+            floor = cache.floor
+            if seq - 1 <= floor:
+                return self._load_history_tail(room, 0, limit, until=seq - 1)
+            # The cached part of the page, topped up with older messages from the database
+            newer = cache.get_since(floor)
+            if newer is None:
+                continue  # The floor moved meanwhile, try again
+            newer = [message for message in newer if message.seq < seq]
+            older = self._load_history_tail(room, 0, limit - len(newer), until=floor)
+            return older + newer
+
+    def _wait_written(self, until):
+        # Messages evicted from a cache may still sit in the write-behind queue
+        if not self.writer.wait_written(until, timeout=HISTORY_WRITE_WAIT):
+            log.warning("History read went ahead with %d messages unsaved", self.writer.pending_count())
+
+    def _load_history_since(self, room, seq, limit=None, until=None):
+        # Only the room's messages in (seq, until]
+        self._wait_written(until)
+        return [self._to_message(document) for document in self.store.find_since(room, seq, until, limit)]
+
+    def _load_history_tail(self, room, seq, limit, until=None):
+        # The room's newest limit messages in (seq, until], returned oldest first
+        self._wait_written(until)
+        return [self._to_message(document) for document in self.store.find_tail(room, seq, limit, until)]
+
+    def _to_message(self, document):
+        return chatservice_pb2.MessageResponse(
+            username=document['user'],
+            message=document['message'],
+            seq=document['seq'],
+            room=document['room'],
+        )
+
+    def get_chat_history(self, room=DEFAULT_ROOM):
+        return self.get_history_since(room, 0)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="CS4459 chat server")
+    parser.add_argument('--port', type=int, default=50051)
+    parser.add_argument('--mode', choices=['threads', 'aio'], default='threads',
+                        help="thread pool server (one worker per open stream) or asyncio server")
+    parser.add_argument('--workers', type=int, default=10,
+                        help="thread pool size in threads mode")
+    parser.add_argument('--stream-queue', type=int, default=1000,
+                        help="messages buffered per open stream")
+    parser.add_argument('--slow-consumer-policy', choices=SLOW_CONSUMER_POLICIES, default=RESYNC,
+                        help="what to do when a stream's buffer is full")
+    parser.add_argument('--bus', choices=['local', 'mongo'], default='local',
+                        help="run alone, or share messages and username reservations with other nodes through MongoDB")
+    parser.add_argument('--node-id', default=None,
+                        help="stable id of this node in a cluster, required with --bus mongo, "
+                             "a restarted node frees the usernames reserved under it")
+    parser.add_argument('--cache-messages', type=int, default=1000,
+                        help="number of recent messages kept in memory per room")
+    parser.add_argument('--cache-bytes', type=int, default=1024 * 1024,
+                        help="memory budget of each room's recent message cache, "
+                             "so up to --cache-rooms times this in total")
+    parser.add_argument('--cache-rooms', type=int, default=100,
+                        help="number of rooms whose recent messages are cached")
+    parser.add_argument('--write-batch-size', type=int, default=100,
+                        help="messages per database write")
+    parser.add_argument('--write-flush-interval', type=float, default=0.05,
+                        help="seconds a message may wait before its batch is written")
+    parser.add_argument('--durability', choices=[ACK_AFTER_ENQUEUE, ACK_AFTER_FLUSH], default=ACK_AFTER_ENQUEUE,
+                        help="acknowledge messages once queued or once written to the database")
+    parser.add_argument('--store', choices=STORES, default=MONGO,
+                        help="where messages are stored: MongoDB, process memory, or append-only log files")
+    parser.add_argument('--store-path', default='chat_log',
+                        help="directory of the log files with --store log")
+    parser.add_argument('--log-segment-mb', type=int, default=64,
+                        help="size at which a log file is closed and a new one started")
+    parser.add_argument('--retention-max-count', type=int, default=None,
+                        help="messages per room kept in the store, older ones are archived")
+    parser.add_argument('--retention-max-age-days', type=float, default=None,
+                        help="age after which messages are archived")
+    parser.add_argument('--archive-path', default='chat_archive',
+                        help="directory of the compressed archive files")
+    parser.add_argument('--compaction-interval', type=float, default=300,
+                        help="seconds between archiving runs")
+    parser.add_argument('--rate-limit', type=float, default=20,
+                        help="messages per second each user may send, 0 for no limit")
+    parser.add_argument('--rate-burst', type=int, default=40,
+                        help="messages a user may send at once before the rate limit applies")
+    parser.add_argument('--max-occupancy', type=float, default=0.9,
+                        help="share of busy workers above which new messages are refused, threads mode")
+    parser.add_argument('--max-write-queue', type=int, default=10000,
+                        help="unsaved messages above which new messages are refused, 0 for no limit")
+    parser.add_argument('--compression', choices=list(COMPRESSION_ALGORITHMS), default='gzip',
+                        help="compression of history replays and message batches")
+    parser.add_argument('--compression-threshold', type=int, default=1024,
+                        help="responses smaller than this many bytes are sent uncompressed")
+    parser.add_argument('--keepalive-time-ms', type=int, default=30000,
+                        help="interval of keepalive pings on idle connections")
+    parser.add_argument('--stream-window-bytes', type=int, default=1024 * 1024,
+                        help="initial HTTP/2 flow control window of each stream")
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help="DEBUG also logs every chat message")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="serve metrics at http://127.0.0.1:<port>/metrics, 0 to disable")
+    parser.add_argument('--metrics-interval', type=float, default=0,
+                        help="log a metrics summary every this many seconds, 0 to disable")
+    args = parser.parse_args()
+    if args.bus == 'mongo' and args.store != MONGO:
+        # Other nodes' messages arrive through a change stream on the messages collection
+        parser.error("--bus mongo needs --store mongo")
+    if args.bus == 'mongo' and not args.node_id:
+        # Usernames are reserved under the node id, a random one would leave them reserved after a crash
+        parser.error("--bus mongo needs --node-id")
+    retention = args.retention_max_count is not None or args.retention_max_age_days is not None
+    if retention and args.bus == 'mongo':
+        # The archive index lives in this process, other nodes would not see new files
+        parser.error("retention is only supported on a single node")
+    return args
+
+def configure_logging(level):
+    # Records are formatted and written by a listener thread, so a slow
+    # stdout never holds up a request
+    records = queue.Queue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    listener = logging.handlers.QueueListener(records, handler)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    listener.start()
+    return listener
+
+def serve():
+    args = parse_args()
+    log_listener = configure_logging(args.log_level)
+    mongo_client = MongoClient('localhost', 27017) if MONGO in (args.store, args.bus) else None
+    bus = MongoChangeStreamBus(mongo_client.chat_db) if args.bus == 'mongo' else None
+    if args.store == MEMORY:
+        store = MemoryStore()
+    elif args.store == LOG:
+        store = LogStore(args.store_path, segment_bytes=args.log_segment_mb * 1024 * 1024)
+    else:
+        store = MongoStore(mongo_client.chat_db, DEFAULT_ROOM)
+    retention = RetentionPolicy(
+        max_age_seconds=args.retention_max_age_days * 86400 if args.retention_max_age_days is not None else None,
+        max_count=args.retention_max_count,
+    )
+    # An existing archive stays readable even with retention turned off
+    archive = Archive(args.archive_path) if retention.enabled or os.path.isdir(args.archive_path) else None
+    chat_service = ChatService(
+        cache_messages=args.cache_messages,
+        cache_bytes=args.cache_bytes,
+        cache_rooms=args.cache_rooms,
+        write_batch_size=args.write_batch_size,
+        write_flush_interval=args.write_flush_interval,
+        durability=args.durability,
+        stream_queue=args.stream_queue,
+        slow_consumer_policy=args.slow_consumer_policy,
+        store=store,
+        retention=retention,
+        archive=archive,
+        compaction_interval=args.compaction_interval,
+        rate_limit=args.rate_limit,
+        rate_burst=args.rate_burst,
+        workers=args.workers if args.mode == 'threads' else None,
+        max_occupancy=args.max_occupancy,
+        max_write_queue=args.max_write_queue,
+        bus=bus,
+        node_id=args.node_id,
+        transport=TransportConfig(
+            compression=args.compression,
+            compression_threshold=args.compression_threshold,
+            keepalive_time_ms=args.keepalive_time_ms,
+            stream_window_bytes=args.stream_window_bytes,
+        ),
+    )
+    address = f'[::]:{args.port}'
+
+    if args.metrics_port:
+        serve_metrics(chat_service.metrics, args.metrics_port)
+        log.info("Metrics at http://127.0.0.1:%d/metrics", args.metrics_port)
+    stop_dump = threading.Event()
+    if args.metrics_interval:
+        dump_metrics(chat_service.metrics, args.metrics_interval, stop_dump)
+
+    if args.mode == 'aio':
+        from aio_server import serve_aio
+        try:
+            asyncio.run(serve_aio(chat_service, address))
+        except KeyboardInterrupt:
+            log.info("Closing server")
+    else:
+        server = grpc.server(
+            futures.ThreadPoolExecutor(max_workers=args.workers),
+            options=chat_service.transport.server_options(),
+            interceptors=[MetricsInterceptor(chat_service.metrics), AdmissionInterceptor(chat_service.admission)],
+        )
+        chatservice_pb2_grpc.add_ChatServiceServicer_to_server(chat_service, server)
+        server.add_insecure_port(address)
+        server.start()
+
+        log.info("Server started")
+        try:
+            while True:
+                time.sleep(86400)
+        except KeyboardInterrupt:
+            log.info("Closing server")
+            # Let in-flight requests finish before the write-behind queue is drained
+            server.stop(grace=2).wait()
+
+    stop_dump.set()
+    log.info("History cache: %s", chat_service.cache_stats())
+    log.info("Streams: %s", chat_service.broker.stats())
+    chat_service.close()
+    log_listener.stop()
 
 if __name__ == '__main__':
     serve()
\ No newline at end of file
@@ -0,0 +1,396 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+
+log = logging.getLogger(__name__)
+
+# Storage engines selectable with --store
+MONGO = 'mongo'
+MEMORY = 'memory'
+LOG = 'log'
+STORES = [MONGO, MEMORY, LOG]
+
+# MongoDB error code of a unique index violation
+DUPLICATE_KEY = 11000
+
+
+class MessageStore:
+    """Where messages end up once the write-behind stage flushes them.
+
+    Messages are documents with 'seq', 'room', 'user', 'message' and 'ts'
+    (seconds since the epoch, missing on old messages) keys. Reads select
+    one room's messages with a seq in (seq, until], oldest first, so every
+    engine needs an index on (room, seq).
+    """
+
+    def last_seq(self):
+        """Highest seq stored, 0 when empty"""
+        raise NotImplementedError
+
+    def insert_many(self, documents):
+        """Store a batch of documents, all or nothing may be retried"""
+        raise NotImplementedError
+
+    def find_since(self, room, seq, until=None, limit=None):
+        """The oldest limit messages of a room in (seq, until], oldest first"""
+        raise NotImplementedError
+
+    def find_tail(self, room, seq, limit, until=None):
+        """The newest limit messages of a room in (seq, until], oldest first"""
+        raise NotImplementedError
+
+    def room_names(self):
+        """Names of the rooms with stored messages"""
+        raise NotImplementedError
+
+    def count(self, room):
+        raise NotImplementedError
+
+    def delete_through(self, room, seq):
+        """Remove a room's messages up to and including seq"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MongoStore(MessageStore):
+    """Messages in the db.messages collection of a MongoDB database"""
+
+    FIELDS = {'_id': 0, 'seq': 1, 'room': 1, 'user': 1, 'message': 1, 'ts': 1}
+
+    def __init__(self, db, default_room, batch_size=500):
+        self.db = db
+        self.batch_size = batch_size
+        self._upgrade(default_room)
+        self.db.messages.create_index([('seq', ASCENDING)], unique=True)
+        self.db.messages.create_index([('room', ASCENDING), ('seq', ASCENDING)])
+
+    def _upgrade(self, default_room):
+        # Messages stored before rooms existed belong to the default room
+        self.db.messages.update_many({'room': {'$exists': False}}, {'$set': {'room': default_room}})
+
+        # Number any messages stored before sequence ids existed, in insertion order
+        last_seq = self.last_seq()
+        for message in self.db.messages.find({'seq': {'$exists': False}}, {'_id': 1}).sort('_id', ASCENDING):
+            last_seq += 1
+            self.db.messages.update_one({'_id': message['_id']}, {'$set': {'seq': last_seq}})
+
+    def last_seq(self):
+        last = self.db.messages.find_one({'seq': {'$exists': True}}, sort=[('seq', DESCENDING)])
+        return last['seq'] if last else 0
+
+    def insert_many(self, documents):
+        # insert_many adds an _id to each document, don't hand it the caller's dicts.
+        # Unordered, so a document already stored by a retried batch doesn't stop the rest
+        try:
+            self.db.messages.insert_many([dict(document) for document in documents], ordered=False)
+        except BulkWriteError as e:
+            errors = [error for error in e.details.get('writeErrors', []) if error.get('code') != DUPLICATE_KEY]
+            if errors or e.details.get('writeConcernErrors'):
+                raise
+
+    def _query(self, room, seq, until):
+        seq_range = {'$gt': seq}
+        if until is not None:
+            seq_range['$lte'] = until
+        return {'room': room, 'seq': seq_range}
+
+    def find_since(self, room, seq, until=None, limit=None):
+        # Walked over the (room, seq) index
+        cursor = self.db.messages.find(self._query(room, seq, until), self.FIELDS)
+        cursor = cursor.sort('seq', ASCENDING).batch_size(self.batch_size)
+        if limit:
+            cursor = cursor.limit(limit)
+        return list(cursor)
+
+    def find_tail(self, room, seq, limit, until=None):
+        cursor = self.db.messages.find(self._query(room, seq, until), self.FIELDS)
+        cursor = cursor.sort('seq', DESCENDING).limit(limit)
+        return list(cursor)[::-1]
+
+    def room_names(self):
+        return self.db.messages.distinct('room')
+
+    def count(self, room):
+        return self.db.messages.count_documents({'room': room})
+
+    def delete_through(self, room, seq):
+        self.db.messages.delete_many({'room': room, 'seq': {'$lte': seq}})
+
+
+class MemoryStore(MessageStore):
+    """Messages kept in process memory, lost on restart.
+
+    For tests, benchmarks and small deployments that don't need history
+    to survive the server.
+    """
+
+    def __init__(self):
+        self.rooms = {}  # room -> (seqs, documents), both sorted by seq
+        self.lock = threading.Lock()
+        self.max_seq = 0
+
+    def last_seq(self):
+        return self.max_seq
+
+    def insert_many(self, documents):
+        with self.lock:
+            for document in documents:
+                seqs, stored = self.rooms.setdefault(document['room'], ([], []))
+                # Batches are nearly always in seq order, this is an append
+                index = bisect.bisect_left(seqs, document['seq'])
+                if index < len(seqs) and seqs[index] == document['seq']:
+                    continue  # Already stored by a retried batch
+                seqs.insert(index, document['seq'])
+                stored.insert(index, dict(document))
+                self.max_seq = max(self.max_seq, document['seq'])
+
+    def _range(self, room, seq, until):
+        seqs, stored = self.rooms.get(room, ([], []))
+        first = bisect.bisect_right(seqs, seq)
+        last = len(seqs) if until is None else bisect.bisect_right(seqs, until)
+        return stored, first, last
+
+    def find_since(self, room, seq, until=None, limit=None):
+        with self.lock:
+            stored, first, last = self._range(room, seq, until)
+            if limit:
+                last = min(last, first + limit)
+            return stored[first:last]
+
+    def find_tail(self, room, seq, limit, until=None):
+        with self.lock:
+            stored, first, last = self._range(room, seq, until)
+            return stored[max(first, last - limit):last]
+
+    def room_names(self):
+        with self.lock:
+            return [room for room, (seqs, _) in self.rooms.items() if seqs]
+
+    def count(self, room):
+        with self.lock:
+            return len(self.rooms.get(room, ((), ()))[0])
+
+    def delete_through(self, room, seq):
+        with self.lock:
+            seqs, stored = self.rooms.get(room, ([], []))
+            index = bisect.bisect_right(seqs, seq)
+            del seqs[:index]
+            del stored[:index]
+
+
+# Log record header: seq, then the length of the JSON encoded [room, user, message, ts]
+RECORD_HEADER = struct.Struct('<qI')
+
+
+class _Segment:
+    # One file of the log, named after the first seq written to it
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab+')
+        self.size = self.file.seek(0, os.SEEK_END)
+        self.map = None  # Read-only mapping, replaced when the file has grown past it
+
+    def append(self, record):
+        offset = self.size
+        self.file.write(record)
+        self.size += len(record)
+        return offset
+
+    def view(self, end):
+        # A mapping covering at least the first end bytes
+        if self.map is None or len(self.map) < end:
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.map
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class LogStore(MessageStore):
+    """Messages in segmented append-only log files in one directory.
+
+    Each record is a small header (seq, body length) and a JSON body.
+    A segment is closed for writing once it passes segment_bytes and a new
+    one is started. The (room, seq) -> (segment, offset) index is held in
+    compact arrays and rebuilt by scanning the segments on startup; reads
+    go through read-only mmaps of the segment files.
+
+    Records are never rewritten. delete_through drops them from the index
+    and remembers the room's cut-off in deleted.json so they stay gone
+    after a restart, and a closed segment with no live records left is
+    removed.
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, fsync=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.segments = []
+        self.rooms = {}  # room -> (seqs, segment numbers, offsets) as arrays sorted by seq
+        self.live = []  # Indexed records per segment number
+        self.max_seq = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.deleted_path = os.path.join(directory, 'deleted.json')
+        self.deleted = {}  # room -> seq deleted through
+        if os.path.exists(self.deleted_path):
+            with open(self.deleted_path) as f:
+                self.deleted = json.load(f)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                self._open_segment(os.path.join(directory, name))
+
+    def _open_segment(self, path):
+        segment = _Segment(path)
+        number = len(self.segments)
+        self.segments.append(segment)
+        self.live.append(0)
+
+        offset = 0
+        if segment.size:
+            view = segment.view(segment.size)
+            while offset + RECORD_HEADER.size <= segment.size:
+                seq, length = RECORD_HEADER.unpack_from(view, offset)
+                end = offset + RECORD_HEADER.size + length
+                if end > segment.size:
+                    break
+                room = json.loads(view[offset + RECORD_HEADER.size:end])[0]
+                self.max_seq = max(self.max_seq, seq)
+                if seq > self.deleted.get(room, 0):
+                    self._index(room, seq, number, offset)
+                offset = end
+        if offset < segment.size:
+            # A record cut short by a crash, drop it
+            log.warning("Truncating %d bytes of a partial record in %s", segment.size - offset, path)
+            if segment.map is not None:
+                segment.map.close()
+                segment.map = None
+            segment.file.truncate(offset)
+            segment.size = offset
+
+    def _index(self, room, seq, number, offset):
+        seqs, numbers, offsets = self.rooms.setdefault(room, (array('q'), array('i'), array('q')))
+        index = bisect.bisect_left(seqs, seq)
+        if index < len(seqs) and seqs[index] == seq:
+            return False
+        if index == len(seqs):
+            seqs.append(seq)
+            numbers.append(number)
+            offsets.append(offset)
+        else:
+            seqs.insert(index, seq)
+            numbers.insert(index, number)
+            offsets.insert(index, offset)
+        self.live[number] += 1
+        self.max_seq = max(self.max_seq, seq)
+        return True
+
+    def last_seq(self):
+        return self.max_seq
+
+    def insert_many(self, documents):
+        with self.lock:
+            if not self.segments or self.segments[-1].size >= self.segment_bytes:
+                first_seq = min(document['seq'] for document in documents)
+                self._open_segment(os.path.join(self.directory, f"{first_seq:020d}.log"))
+            segment = self.segments[-1]
+            number = len(self.segments) - 1
+
+            for document in documents:
+                seqs = self.rooms.get(document['room'], ((),))[0]
+                index = bisect.bisect_left(seqs, document['seq'])
+                if index < len(seqs) and seqs[index] == document['seq']:
+                    continue  # Already stored by a retried batch
+                if document['seq'] <= self.deleted.get(document['room'], 0):
+                    continue
+                body = json.dumps([document['room'], document['user'], document['message'], document.get('ts')]).encode()
+                offset = segment.append(RECORD_HEADER.pack(document['seq'], len(body)) + body)
+                self._index(document['room'], document['seq'], number, offset)
+
+            segment.file.flush()
+            if self.fsync:
+                os.fsync(segment.file.fileno())
+
+    def _read(self, seq, number, offset):
+        segment = self.segments[number]
+        view = segment.view(offset + RECORD_HEADER.size)
+        _, length = RECORD_HEADER.unpack_from(view, offset)
+        start = offset + RECORD_HEADER.size
+        view = segment.view(start + length)
+        fields = json.loads(view[start:start + length])
+        room, user, message = fields[:3]
+        ts = fields[3] if len(fields) > 3 else None  # Records written before timestamps
+        return {'seq': seq, 'room': room, 'user': user, 'message': message, 'ts': ts}
+
+    def _range(self, room, seq, until, limit, newest):
+        with self.lock:
+            seqs, numbers, offsets = self.rooms.get(room, ((), (), ()))
+            first = bisect.bisect_right(seqs, seq)
+            last = len(seqs) if until is None else bisect.bisect_right(seqs, until)
+            if limit and newest:
+                first = max(first, last - limit)
+            elif limit:
+                last = min(last, first + limit)
+            return [self._read(seqs[i], numbers[i], offsets[i]) for i in range(first, last)]
+
+    def find_since(self, room, seq, until=None, limit=None):
+        return self._range(room, seq, until, limit, newest=False)
+
+    def find_tail(self, room, seq, limit, until=None):
+        return self._range(room, seq, until, limit, newest=True)
+
+    def room_names(self):
+        with self.lock:
+            return [room for room, (seqs, _, _) in self.rooms.items() if seqs]
+
+    def count(self, room):
+        with self.lock:
+            return len(self.rooms.get(room, ((),))[0])
+
+    def delete_through(self, room, seq):
+        with self.lock:
+            if seq <= self.deleted.get(room, 0):
+                return
+            seqs, numbers, offsets = self.rooms.get(room, (array('q'), array('i'), array('q')))
+            index = bisect.bisect_right(seqs, seq)
+            for number in numbers[:index]:
+                self.live[number] -= 1
+            del seqs[:index]
+            del numbers[:index]
+            del offsets[:index]
+
+            self.deleted[room] = seq
+            temporary = self.deleted_path + '.tmp'
+            with open(temporary, 'w') as f:
+                json.dump(self.deleted, f)
+            os.replace(temporary, self.deleted_path)
+
+            # Closed segments whose records have all been deleted
+            for number, segment in enumerate(self.segments[:-1]):
+                if segment is not None and self.live[number] == 0:
+                    segment.close()
+                    os.remove(segment.path)
+                    self.segments[number] = None
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                if segment is not None:
+                    segment.close()
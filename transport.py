@@ -0,0 +1,66 @@
+import grpc
+
+COMPRESSION_ALGORITHMS = {
+    'none': grpc.Compression.NoCompression,
+    'gzip': grpc.Compression.Gzip,
+    'deflate': grpc.Compression.Deflate,
+}
+
+# Trailing metadata key of RESOURCE_EXHAUSTED errors: milliseconds to wait before retrying
+RETRY_AFTER_KEY = 'retry-after-ms'
+
+
+class TransportConfig:
+    """gRPC settings shared by the server and the clients.
+
+    Stream responses are compressed with `compression`, except those
+    smaller than compression_threshold bytes (single live messages,
+    presence replies) where the CPU cost buys next to nothing.
+    """
+
+    def __init__(self, compression='gzip', compression_threshold=1024,
+                 keepalive_time_ms=30000, keepalive_timeout_ms=10000,
+                 max_message_bytes=16 * 1024 * 1024, stream_window_bytes=1024 * 1024):
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.keepalive_time_ms = keepalive_time_ms        # Ping an idle connection this often
+        self.keepalive_timeout_ms = keepalive_timeout_ms  # and drop it if the ping isn't answered
+        self.max_message_bytes = max_message_bytes        # Largest message either side accepts
+        self.stream_window_bytes = stream_window_bytes    # Initial HTTP/2 flow control window per stream
+
+    @property
+    def algorithm(self):
+        return COMPRESSION_ALGORITHMS[self.compression]
+
+    def _common_options(self):
+        return [
+            ('grpc.keepalive_time_ms', self.keepalive_time_ms),
+            ('grpc.keepalive_timeout_ms', self.keepalive_timeout_ms),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+            ('grpc.max_send_message_length', self.max_message_bytes),
+            ('grpc.max_receive_message_length', self.max_message_bytes),
+            # A large starting window lets a history replay fill the link
+            # before BDP probing has grown it
+            ('grpc.http2.lookahead_bytes', self.stream_window_bytes),
+            ('grpc.http2.bdp_probe', 1),
+        ]
+
+    def server_options(self):
+        return self._common_options() + [
+            # Accept the clients' keepalive pings instead of closing the connection
+            ('grpc.http2.min_ping_interval_without_data_ms', min(self.keepalive_time_ms, 10000)),
+        ]
+
+    def channel_options(self):
+        return self._common_options()
+
+    def enable_compression(self, context):
+        # Call at the start of a call whose responses may be large
+        if self.compression != 'none':
+            context.set_compression(self.algorithm)
+
+    def before_send(self, context, response):
+        # Call before returning or yielding each response of such a call
+        if self.compression != 'none' and response.ByteSize() < self.compression_threshold:
+            context.disable_next_message_compression()